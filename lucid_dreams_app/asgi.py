@@ -0,0 +1,259 @@
+import asyncio
+import io
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+
+import auth
+import energy
+import idempotency
+import metrics
+import profiles
+import store
+from app import TELEGRAM_TOKEN, app as wsgi_app, bootstrap_data, handle_update
+from db import run_async
+
+# ASGI-вход: uvicorn asgi:app --workers N
+# API пользователя, покупок и вебхук обрабатываются асинхронно, остальное (страница, статика) отдает Flask-приложение
+
+logger = logging.getLogger(__name__)
+
+# Потоки для запросов, которые обрабатывает Flask-приложение
+wsgi_executor = ThreadPoolExecutor(32, thread_name_prefix="wsgi")
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_response(send, status, body, content_type):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, data, status=200):
+    with metrics.phase("json"):
+        body = json.dumps(data, separators=(',', ':'), sort_keys=True).encode() + b'\n'
+    await send_response(send, status, body, b'application/json')
+
+
+# Тело принимается только с Content-Type JSON, как request.get_json() во Flask:
+# простую форму или text/plain другой сайт может отправить без предварительного CORS-запроса
+def json_body(scope, body):
+    mimetype = (header(scope, 'Content-Type') or '').split(';')[0].strip().lower()
+    if not (mimetype == 'application/json' or (mimetype.startswith('application/') and mimetype.endswith('+json'))):
+        raise HTTPError(415, 'Unsupported Media Type')
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise HTTPError(400, 'Bad Request')
+
+
+def header(scope, name):
+    name = name.lower().encode('latin-1')
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def idempotency_key(scope, data):
+    return header(scope, 'Idempotency-Key') or data.get('idempotency_key')
+
+
+# Пользователь запроса из токена сессии, как current_user в app.py
+def current_user(scope, claimed=None):
+    return auth.authenticate(header(scope, 'Authorization'), claimed)
+
+
+def query(scope):
+    return {k: v[0] for k, v in parse_qs(scope['query_string'].decode()).items()}
+
+
+async def get_user_data(scope, body):
+    return await profiles.get_profile_async(current_user(scope, query(scope).get('user_id')))
+
+
+async def bootstrap(scope, body):
+    args = query(scope)
+    profile, purchases = await profiles.get_profile_with_purchases_async(current_user(scope, args.get('user_id')))
+    return bootstrap_data(profile, purchases, args.get('catalog'))
+
+
+async def set_style(scope, body):
+    data = json_body(scope, body)
+    await profiles.set_style_async(current_user(scope, data.get('user_id')), data['style'])
+    return {"success": True}
+
+
+async def set_language(scope, body):
+    data = json_body(scope, body)
+    await profiles.set_language_async(current_user(scope, data.get('user_id')), data['language'])
+    return {"success": True}
+
+
+async def buy_item(scope, body):
+    data = json_body(scope, body)
+    new_diamonds = await store.buy_item_async(current_user(scope, data.get('user_id')), data['item'], idempotency_key(scope, data))
+    if new_diamonds is None:
+        return {"success": False}
+    return {"success": True, "diamonds": new_diamonds}
+
+
+async def buy_diamonds(scope, body):
+    data = json_body(scope, body)
+    new_diamonds = await store.add_diamonds_async(current_user(scope, data.get('user_id')), data['amount'], idempotency_key(scope, data))
+    if new_diamonds is None:
+        return {"success": False, "error": "User not found after update"}
+    return {"success": True, "diamonds": new_diamonds}
+
+
+async def spend_energy(scope, body):
+    data = json_body(scope, body)
+    remaining = await energy.spend_async(current_user(scope, data.get('user_id')), data['amount'])
+    if remaining is None:
+        return {"success": False}
+    return {"success": True, "energy": remaining}
+
+
+ROUTES = {
+    ('GET', '/get_user_data'): get_user_data,
+    ('GET', '/bootstrap'): bootstrap,
+    ('POST', '/set_style'): set_style,
+    ('POST', '/set_language'): set_language,
+    ('POST', '/buy_item'): buy_item,
+    ('POST', '/buy_diamonds'): buy_diamonds,
+    ('POST', '/spend_energy'): spend_energy,
+}
+
+
+async def webhook(scope, send, body):
+    await run_async(handle_update, json_body(scope, body))
+    await send_response(send, 200, b'OK', b'text/html; charset=utf-8')
+
+
+# Запрос учитывается в метриках при отправке заголовков ответа, к ним добавляется Server-Timing.
+# Маршруты называются так же, как обработчики Flask-приложения.
+def timed_send(send, route, method):
+    metrics.begin(route, method)
+
+    async def wrapper(message):
+        if message['type'] == 'http.response.start':
+            timer = metrics.end(message['status'])
+            if timer is not None:
+                message = dict(message, headers=list(message['headers']) + [(b'server-timing', metrics.server_timing(timer).encode())])
+        await send(message)
+    return wrapper
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+        else:
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+# Запуск Flask-приложения в отдельном потоке; тело ответа передается по частям
+async def call_wsgi(scope, body, send):
+    loop = asyncio.get_running_loop()
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    def first_chunk():
+        result = wsgi_app(wsgi_environ(scope, body), start_response)
+        iterator = iter(result)
+        return result, iterator, next(iterator, b'')
+
+    result, iterator, chunk = await loop.run_in_executor(wsgi_executor, first_chunk)
+    try:
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        while chunk:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(wsgi_executor, next, iterator, b'')
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(wsgi_executor, result.close)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    body = await read_body(receive)
+    handler = ROUTES.get((scope['method'], scope['path']))
+    is_webhook = handler is None and scope['method'] == 'POST' and scope['path'] == f'/{TELEGRAM_TOKEN}'
+    # Запросы, переданные во Flask, учитывает само Flask-приложение
+    if handler is not None or is_webhook:
+        send = timed_send(send, handler.__name__ if handler is not None else 'webhook', scope['method'])
+    try:
+        if handler is not None:
+            await send_json(send, await handler(scope, body))
+        elif is_webhook:
+            await webhook(scope, send, body)
+        else:
+            await call_wsgi(scope, body, send)
+    except auth.AuthError as e:
+        await send_json(send, {"success": False, "error": str(e)}, status=e.status)
+    except idempotency.Conflict as e:
+        await send_json(send, {"success": False, "error": str(e)}, status=422)
+    except HTTPError as e:
+        await send_response(send, e.status, e.message.encode(), b'text/plain; charset=utf-8')
+    except (KeyError, TypeError, ValueError):
+        await send_response(send, 400, b'Bad Request', b'text/plain; charset=utf-8')
+    except Exception:
+        logger.exception("request to %s failed", scope['path'])
+        await send_response(send, 500, b'Internal Server Error', b'text/plain; charset=utf-8')
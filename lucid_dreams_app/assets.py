@@ -0,0 +1,57 @@
+import hashlib
+import os
+import re
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, 'static')
+
+# Адреса с хэшем содержимого никогда не меняются, их можно кэшировать навсегда
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()[:12]
+
+
+def hashed_name(path, digest):
+    stem, ext = os.path.splitext(path)
+    return f'{stem}.{digest}{ext}'
+
+
+# Манифест: путь файла в static/ -> путь с хэшем содержимого, и обратное отображение
+def build_manifest(root=STATIC_DIR):
+    manifest = {}
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            if name.startswith('.'):
+                continue
+            full = os.path.join(directory, name)
+            path = os.path.relpath(full, root).replace(os.sep, '/')
+            manifest[path] = hashed_name(path, file_digest(full))
+    return manifest
+
+
+MANIFEST = build_manifest()
+HASHED = {hashed: path for path, hashed in MANIFEST.items()}
+
+
+def url(path):
+    return '/static/' + MANIFEST.get(path, path)
+
+
+# Исходный путь для адреса с хэшем или None, если адрес без хэша
+def resolve(hashed_path):
+    return HASHED.get(hashed_path)
+
+
+STATIC_URL = re.compile(r"/static/([^\"'\s)]+)")
+
+
+# Заменяет в разметке ссылки на static/ адресами с хэшем
+def rewrite(html):
+    return STATIC_URL.sub(lambda m: url(m.group(1)) if m.group(1) in MANIFEST else m.group(0), html)
@@ -0,0 +1,104 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from urllib.parse import parse_qsl
+
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
+# initData старше этого времени (секунды) не принимается
+INIT_DATA_MAX_AGE = int(os.getenv("INIT_DATA_MAX_AGE", "86400"))
+# initData проверяется один раз в /auth, дальше запросы идут с подписанным токеном сессии
+SESSION_TTL = int(os.getenv("SESSION_TTL", "21600"))
+SESSION_COOKIE = 'session'
+# Без AUTH_REQUIRED запросы без токена по-прежнему могут передать user_id сами (для старых клиентов)
+AUTH_REQUIRED = os.getenv("AUTH_REQUIRED", "1") == "1"
+
+# Ключ проверки подписи initData зависит только от токена бота и вычисляется один раз
+SECRET_KEY = hmac.new(b"WebAppData", TELEGRAM_TOKEN.encode(), hashlib.sha256).digest()
+# Ключ подписи токенов общий для всех воркеров: задается SESSION_SECRET или выводится из токена бота
+SESSION_KEY = hmac.new(b"session", (os.getenv("SESSION_SECRET") or TELEGRAM_TOKEN).encode(), hashlib.sha256).digest()
+
+
+class AuthError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Проверка initData мини-приложения Telegram; возвращает словарь user или None, если подпись неверна или устарела
+def validate_init_data(init_data, now=None):
+    if not init_data:
+        return None
+    try:
+        fields = dict(parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
+    except ValueError:
+        return None
+    received = fields.pop('hash', None)
+    if received is None:
+        return None
+    check_string = '\n'.join(f'{key}={value}' for key, value in sorted(fields.items()))
+    expected = hmac.new(SECRET_KEY, check_string.encode(), hashlib.sha256).hexdigest()
+    # Сравнение байтов: compare_digest на строках с не-ASCII символами бросает TypeError
+    if not hmac.compare_digest(expected.encode(), received.encode()):
+        return None
+    try:
+        auth_date = int(fields['auth_date'])
+        user = json.loads(fields['user'])
+    except (KeyError, ValueError):
+        return None
+    now = time.time() if now is None else now
+    if now - auth_date > INIT_DATA_MAX_AGE:
+        return None
+    return user
+
+
+def _sign(payload):
+    digest = hmac.digest(SESSION_KEY, payload.encode(), 'sha256')[:18]
+    return base64.urlsafe_b64encode(digest).decode()
+
+
+# Токен сессии "user_id.срок.подпись"; проверка - одна HMAC и сравнение за постоянное время
+def issue_session(user_id, now=None):
+    now = time.time() if now is None else now
+    payload = f'{int(user_id)}.{int(now) + SESSION_TTL}'
+    return f'{payload}.{_sign(payload)}'
+
+
+def verify_session(token, now=None):
+    if not token:
+        return None
+    payload, _, signature = token.rpartition('.')
+    if not hmac.compare_digest(_sign(payload).encode(), signature.encode()):
+        return None
+    user_id, _, expires = payload.partition('.')
+    now = time.time() if now is None else now
+    try:
+        if int(expires) < now:
+            return None
+        return int(user_id)
+    except ValueError:
+        return None
+
+
+# Пользователь запроса по заголовку Authorization: Bearer <токен>.
+# claimed - user_id из запроса; он должен совпадать с пользователем сессии.
+# Cookie сессии для API не принимается: ее браузер приложит и к запросу с чужого сайта (CSRF),
+# она нужна только для готовой страницы /webapp.
+def authenticate(authorization, claimed=None):
+    try:
+        claimed = int(claimed) if claimed is not None else None
+    except (TypeError, ValueError):
+        raise AuthError(400, "invalid user_id")
+    token = authorization[7:] if authorization and authorization.startswith('Bearer ') else None
+    if not token:
+        if not AUTH_REQUIRED and claimed is not None:
+            return claimed
+        raise AuthError(401, "authentication required")
+    user_id = verify_session(token)
+    if user_id is None:
+        raise AuthError(401, "invalid or expired session")
+    if claimed is not None and claimed != user_id:
+        raise AuthError(403, "user_id does not match the session")
+    return user_id
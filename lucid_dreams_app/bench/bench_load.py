@@ -0,0 +1,481 @@
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Нагрузочный тест: python bench/bench_load.py --users 100000 --clients 32 --duration 30
+# Поднимает приложение (gunicorn или uvicorn) на засеянной базе, гоняет смешанную нагрузку
+# и сохраняет результаты в bench/results/*.json. Сравнение двух прогонов:
+# python bench/bench_load.py --compare old.json new.json
+
+TELEGRAM_TOKEN = '123456:BENCHTOKEN'
+ITEMS = ['pajamas', 'lingerie', 'cat_ears', 'vip_pass', 'wine_bottle', 'control_charm', 'flower_bouquet']
+LANGUAGES = ['Русский', 'English', 'Français', 'Italiano', 'Deutsch', 'Español']
+DEFAULT_MIX = 'launch=30,browse=30,purchase=20,language=10,webhook=10'
+# Секрет служебных маршрутов приложения (/slow_queries), если PROFILER_SECRET не задан
+ADMIN_SECRET = os.getenv('PROFILER_SECRET') or uuid.uuid4().hex
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def app_env(db_path, workdir, bot_port):
+    env = dict(os.environ)
+    env.pop('DB_SHARDS', None)
+    env.update({
+        'DB_PATH': db_path,
+        'DB_SHARD_MAP': db_path + '.shards.json',
+        'OUTBOX_DB': os.path.join(workdir, 'outbox.db'),
+        'CACHE_SHM_DIR': workdir,
+        'TELEGRAM_TOKEN': TELEGRAM_TOKEN,
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{bot_port}',
+        'WEBAPP_URL': 'https://example.com/webapp',
+    })
+    # Полные просмотры больших таблиц в запросах попадают в результаты прогона
+    env.setdefault('SQL_SCAN_CHECK', 'warn')
+    env['PROFILER_SECRET'] = ADMIN_SECRET
+    return env
+
+
+# Засеянная база: схема из миграций приложения, пользователи, покупки и начальные записи журнала
+def seed(path, users, seed_value):
+    env = app_env(path, os.path.dirname(path), 0)
+    subprocess.run([sys.executable, '-c', 'import schema; schema.migrate()'], cwd=APP_DIR, env=env, check=True)
+    rng = random.Random(seed_value)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -262144")
+    now = int(time.time())
+    batch = 100000
+    for start in range(1, users + 1, batch):
+        ids = range(start, min(start + batch, users + 1))
+        rows = [(user_id, rng.choice((0, 0, 85, 210, 540, 1360)), rng.choice(LANGUAGES[:2])) for user_id in ids]
+        conn.executemany("INSERT INTO users (user_id, diamonds, language) VALUES (?, ?, ?)", rows)
+        conn.executemany("INSERT INTO ledger (user_id, delta, reason, created_at) VALUES (?, ?, 'opening', ?)",
+                         [(user_id, diamonds, now) for user_id, diamonds, _ in rows if diamonds])
+        owned = [(user_id, rng.choice(ITEMS)) for user_id in ids if rng.random() < 0.3]
+        conn.executemany("INSERT INTO purchases (user_id, item, price, created_at) VALUES (?, ?, 0, ?)",
+                         [(user_id, item, now) for user_id, item in owned])
+        conn.executemany("INSERT INTO inventory (user_id, item, count) VALUES (?, ?, 1) "
+                         "ON CONFLICT(user_id, item) DO UPDATE SET count = count + 1", owned)
+        conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+def seeded_db(args):
+    data_dir = os.path.join(BENCH_DIR, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f'users-{args.users}-{args.seed}.db')
+    if args.reseed or not os.path.exists(path):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        started = time.monotonic()
+        seed(path, args.users, args.seed)
+        print(f'seeded {args.users} users in {time.monotonic() - started:.1f}s', file=sys.stderr)
+    return path
+
+
+# Раскладывает пользователей по шардам users, users-1, ... тем же reshard.py, что и в продакшене
+def split(db_path, workdir, shards):
+    paths = [db_path] + [os.path.join(workdir, f'users-{i}.db') for i in range(1, shards)]
+    env = dict(app_env(db_path, workdir, 0), RESHARD_GRACE='0', RESHARD_PAUSE='0')
+    started = time.monotonic()
+    subprocess.run([sys.executable, 'reshard.py', 'apply'] + paths, cwd=APP_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+    print(f'split into {shards} shards in {time.monotonic() - started:.1f}s', file=sys.stderr)
+
+
+# Фейковый Bot API: отправители исходящих сообщений ходят сюда вместо api.telegram.org
+class FakeBotAPI(BaseHTTPRequestHandler):
+    sent = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        FakeBotAPI.sent += 1
+        body = json.dumps({"ok": True, "result": {"message_id": FakeBotAPI.sent, "date": 0,
+                                                  "chat": {"id": 1, "type": "private"}, "text": ""}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(args, db_path, workdir, port, bot_port):
+    env = app_env(db_path, workdir, bot_port)
+    if args.server == 'uvicorn':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port),
+                   '--workers', str(args.workers), '--log-level', 'warning', '--no-access-log']
+    else:
+        command = [sys.executable, '-m', 'gunicorn', 'app:app', '-b', f'127.0.0.1:{port}', '-w', str(args.workers),
+                   '-k', args.worker_class, '--threads', str(args.threads), '--log-level', 'warning']
+    process = subprocess.Popen(command, cwd=APP_DIR, env=env)
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/webapp')
+            if conn.getresponse().status == 200:
+                return process
+        except OSError:
+            pass
+        if process.poll() is not None:
+            raise SystemExit(f'server exited with code {process.returncode}')
+        time.sleep(0.2)
+    process.terminate()
+    raise SystemExit('server did not start')
+
+
+# Адреса статики, картинок и пакетов переводов берутся из самой страницы
+def discover(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/webapp')
+    page = conn.getresponse().read().decode()
+    return {
+        "static": sorted(set(re.findall(r'/static/[\w./-]+\.[0-9a-f]{8,}\.\w+', page)))[:20],
+        "images": sorted(set(re.findall(r'/images/\d+/[0-9a-f]+/[\w.-]+', page)))[:20],
+        "bundles": sorted(set(re.findall(r'/i18n/[\w.]+\.json', page))),
+    }
+
+
+# Сводки /slow_queries со всех воркеров: запросы распределяются между ними, поэтому спрашиваем несколько раз
+def slow_queries(port, workers):
+    reports = {}
+    for _ in range(workers * 10):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/slow_queries', headers={'X-Profiler-Secret': ADMIN_SECRET})
+        report = json.loads(conn.getresponse().read())
+        reports[report['pid']] = report
+        if len(reports) == workers:
+            break
+    slow = {}
+    scans = {}
+    for report in reports.values():
+        for entry in report['slow']:
+            merged = slow.setdefault(entry['statement'], dict(entry, count=0, total_ms=0, max_ms=0))
+            merged['count'] += entry['count']
+            merged['total_ms'] = round(merged['total_ms'] + entry['total_ms'], 3)
+            merged['max_ms'] = max(merged['max_ms'], entry['max_ms'])
+        for entry in report['full_scans']:
+            scans[entry['statement']] = entry
+    return {
+        "workers_reported": len(reports),
+        "slow": sorted(slow.values(), key=lambda entry: entry['total_ms'], reverse=True)[:20],
+        "full_scans": list(scans.values()),
+    }
+
+
+class Client:
+    def __init__(self, port, urls, users, rng, results, issue_session):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        self.issue_session = issue_session
+        self.urls = urls
+        self.users = users
+        self.rng = rng
+        self.results = results
+
+    # Активные пользователи встречаются чаще: квадрат равномерного распределения
+    def user(self):
+        return 1 + int(self.users * self.rng.random() ** 2) % self.users
+
+    def request(self, name, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        headers.setdefault('Accept-Encoding', 'br, gzip')
+        started = time.perf_counter()
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            status = 0
+        elapsed = (time.perf_counter() - started) * 1000
+        self.results.setdefault(name, {"latencies": [], "errors": 0, "client_errors": 0})
+        entry = self.results[name]
+        entry["latencies"].append(elapsed)
+        if status == 0 or status >= 500:
+            entry["errors"] += 1
+        elif status >= 400:
+            entry["client_errors"] += 1
+
+    # Токен подписывается тем же ключом, что и в приложении (ключ выводится из TELEGRAM_TOKEN)
+    def session(self, user_id):
+        token = self.issue_session(user_id)
+        return {'Authorization': f'Bearer {token}', 'Cookie': f'session={token}'}
+
+    # Запуск мини-приложения: с cookie сессии страница приходит с данными, иначе нужен /bootstrap
+    def launch(self):
+        user_id = self.user()
+        if self.rng.random() < 0.5:
+            self.request('GET /webapp (prerendered)', 'GET', '/webapp', headers=self.session(user_id))
+        else:
+            self.request('GET /webapp', 'GET', '/webapp')
+            self.request('GET /bootstrap', 'GET', '/bootstrap?catalog=', headers=self.session(user_id))
+
+    def browse(self):
+        user_id = self.user()
+        self.request('GET /get_user_data', 'GET', '/get_user_data', headers=self.session(user_id))
+        for kind in ('static', 'images', 'bundles'):
+            if self.urls[kind]:
+                self.request(f'GET /{kind}', 'GET', self.rng.choice(self.urls[kind]))
+
+    # Покупка; часть запросов повторяется с тем же ключом, как при сбое сети
+    def purchase(self):
+        headers = self.session(self.user())
+        if self.rng.random() < 0.3:
+            body, name, path = {"amount": self.rng.choice((85, 210, 540))}, 'POST /buy_diamonds', '/buy_diamonds'
+        else:
+            body, name, path = {"item": self.rng.choice(ITEMS)}, 'POST /buy_item', '/buy_item'
+        headers['Idempotency-Key'] = uuid.uuid4().hex
+        self.request(name, 'POST', path, body, headers)
+        if self.rng.random() < 0.1:
+            self.request(name + ' (replay)', 'POST', path, body, headers)
+
+    def language(self):
+        user_id = self.user()
+        headers = self.session(user_id)
+        self.request('POST /set_language', 'POST', '/set_language', {"language": self.rng.choice(LANGUAGES)}, headers)
+        self.request('GET /webapp (prerendered)', 'GET', '/webapp', headers=headers)
+
+    # Пачка обновлений от Telegram подряд, как после рассылки
+    def webhook(self):
+        for _ in range(self.rng.randint(5, 20)):
+            update_id = self.rng.getrandbits(52)
+            chat_id = self.user()
+            update = {"update_id": update_id, "message": {"message_id": 1, "date": int(time.time()), "text": "/start",
+                                                          "chat": {"id": chat_id, "type": "private"}}}
+            self.request('POST webhook', 'POST', f'/{TELEGRAM_TOKEN}', update)
+
+
+def client_process(port, urls, users, mix, clients, deadline, seed_value, queue):
+    sys.path.insert(0, APP_DIR)
+    os.environ['TELEGRAM_TOKEN'] = TELEGRAM_TOKEN
+    import auth
+    names, weights = zip(*mix.items())
+    results = {}
+    lock = threading.Lock()
+
+    def run(index):
+        rng = random.Random(seed_value * 1000 + index)
+        local = {}
+        client = Client(port, urls, users, rng, local, auth.issue_session)
+        while time.time() < deadline:
+            getattr(client, rng.choices(names, weights)[0])()
+        with lock:
+            for name, entry in local.items():
+                merged = results.setdefault(name, {"latencies": [], "errors": 0, "client_errors": 0})
+                merged["latencies"].extend(entry["latencies"])
+                merged["errors"] += entry["errors"]
+                merged["client_errors"] += entry["client_errors"]
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.put(results)
+
+
+# Ожидание блокировки записи SQLite: пробный BEGIN IMMEDIATE каждые interval секунд
+def lock_probe(db_path, deadline, interval, waits):
+    conn = sqlite3.connect(db_path, isolation_level=None, timeout=30)
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            waits.append((time.perf_counter() - started) * 1000)
+            conn.execute("ROLLBACK")
+        except sqlite3.OperationalError:
+            waits.append((time.perf_counter() - started) * 1000)
+        time.sleep(interval)
+    conn.close()
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))], 3)
+
+
+def summarize(latencies, seconds):
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "throughput": round(len(ordered) / seconds, 1),
+        "p50_ms": percentile(ordered, 50),
+        "p95_ms": percentile(ordered, 95),
+        "p99_ms": percentile(ordered, 99),
+        "max_ms": round(ordered[-1], 3) if ordered else None,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def run(args):
+    mix = {name: float(weight) for name, weight in (part.split('=') for part in args.mix.split(','))}
+    source = seeded_db(args)
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    db_path = os.path.join(workdir, 'users.db')
+    # Каждый прогон начинается с одной и той же копии засеянной базы
+    shutil.copyfile(source, db_path)
+    if args.shards > 1:
+        split(db_path, workdir, args.shards)
+
+    bot = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotAPI)
+    threading.Thread(target=bot.serve_forever, daemon=True).start()
+    port = free_port()
+    server = start_server(args, db_path, workdir, port, bot.server_address[1])
+    try:
+        urls = discover(port)
+        context = multiprocessing.get_context('spawn')
+        queue = context.Queue()
+        started = time.time()
+        deadline = started + args.duration
+        waits = []
+        probe = threading.Thread(target=lock_probe, args=(db_path, deadline, args.probe_interval, waits))
+        probe.start()
+        per_process = max(1, args.clients // args.client_processes)
+        processes = [context.Process(target=client_process,
+                                     args=(port, urls, args.users, mix, per_process, deadline, args.seed + i, queue))
+                     for i in range(args.client_processes)]
+        for process in processes:
+            process.start()
+        parts = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        probe.join()
+        seconds = time.time() - started
+        queries = slow_queries(port, args.workers)
+    finally:
+        server.terminate()
+        server.wait()
+        bot.shutdown()
+
+    endpoints = {}
+    for part in parts:
+        for name, entry in part.items():
+            merged = endpoints.setdefault(name, {"latencies": [], "errors": 0, "client_errors": 0})
+            merged["latencies"].extend(entry["latencies"])
+            merged["errors"] += entry["errors"]
+            merged["client_errors"] += entry["client_errors"]
+    everything = [latency for entry in endpoints.values() for latency in entry["latencies"]]
+    ordered_waits = sorted(waits)
+    result = {
+        "config": {
+            "users": args.users, "seed": args.seed, "duration": args.duration, "clients": per_process * args.client_processes,
+            "client_processes": args.client_processes, "server": args.server, "workers": args.workers,
+            "worker_class": args.worker_class if args.server == 'gunicorn' else 'uvicorn', "threads": args.threads,
+            "mix": mix, "shards": args.shards,
+        },
+        "environment": {
+            "revision": git_revision(), "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+            "cpus": os.cpu_count(), "platform": platform.platform(),
+        },
+        "started_at": int(started),
+        "seconds": round(seconds, 3),
+        "total": dict(summarize(everything, seconds), errors=sum(e["errors"] for e in endpoints.values())),
+        "endpoints": {
+            name: dict(summarize(entry["latencies"], seconds), errors=entry["errors"], client_errors=entry["client_errors"])
+            for name, entry in sorted(endpoints.items())
+        },
+        "lock_wait": {
+            "probes": len(ordered_waits),
+            "p50_ms": percentile(ordered_waits, 50),
+            "p95_ms": percentile(ordered_waits, 95),
+            "p99_ms": percentile(ordered_waits, 99),
+            "max_ms": round(ordered_waits[-1], 3) if ordered_waits else None,
+            "mean_ms": round(sum(ordered_waits) / len(ordered_waits), 3) if ordered_waits else None,
+        },
+        "telegram_messages_sent": FakeBotAPI.sent,
+        "sql": queries,
+    }
+    shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+# Разница двух прогонов по пропускной способности и p95 для каждого эндпоинта
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'endpoint':32} {'rps old':>9} {'rps new':>9} {'rps %':>7} {'p95 old':>9} {'p95 new':>9} {'p95 %':>7}")
+    rows = [('TOTAL', old['total'], new['total'])]
+    rows += [(name, old['endpoints'].get(name), new['endpoints'][name]) for name in new['endpoints']]
+    for name, a, b in rows:
+        if not a:
+            continue
+
+        def delta(key):
+            return f"{(b[key] - a[key]) / a[key] * 100:+.1f}" if a[key] and b[key] is not None else '-'
+        print(f"{name:32} {a['throughput']:>9} {b['throughput']:>9} {delta('throughput'):>7} "
+              f"{a['p95_ms']:>9} {b['p95_ms']:>9} {delta('p95_ms'):>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reseed', action='store_true')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--client-processes', type=int, default=2)
+    parser.add_argument('--server', choices=['gunicorn', 'uvicorn'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=max(2, os.cpu_count() or 1))
+    parser.add_argument('--worker-class', default='gthread')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    # Число файлов SQLite; блокировка записи замеряется на первом из них
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--probe-interval', type=float, default=0.05)
+    parser.add_argument('--out')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    result = run(args)
+    out = args.out or os.path.join(BENCH_DIR, 'results', f"{time.strftime('%Y%m%d-%H%M%S')}-{args.server}-{args.users}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    full_scans = [entry["statement"] for entry in result["sql"]["full_scans"]]
+    print(json.dumps({"out": out, "total": result["total"], "lock_wait": result["lock_wait"], "full_scans": full_scans}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
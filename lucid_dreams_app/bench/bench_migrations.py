@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Замер миграций: python bench/bench_migrations.py --rows 1000000
+# Создает базу со старой схемой, применяет миграции и заполнения и печатает время на миллион строк.
+
+
+def seed_legacy(path, rows, users):
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        diamonds INTEGER DEFAULT 0,
+        energy INTEGER DEFAULT 100,
+        style TEXT DEFAULT 'nika',
+        language TEXT DEFAULT 'Русский'
+    )''')
+    conn.execute("CREATE TABLE purchases (user_id INTEGER, item TEXT, FOREIGN KEY(user_id) REFERENCES users(user_id))")
+    conn.executemany("INSERT INTO users (user_id) VALUES (?)", ((i,) for i in range(users)))
+    items = ['pajamas', 'lingerie', 'cat_ears', 'vip_pass', 'wine_bottle', 'control_charm', 'flower_bouquet']
+    conn.executemany("INSERT INTO purchases VALUES (?, ?)", ((i * 7919 % users, items[i % len(items)]) for i in range(rows)))
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=5000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'users.db')
+    os.environ['DB_PATH'] = path
+    sys.path.insert(0, APP_DIR)
+    import schema
+
+    started = time.monotonic()
+    seed_legacy(path, args.rows, args.users)
+    seeded = time.monotonic()
+    schema.migrate()
+    migrated = time.monotonic()
+    schema.run_backfills(batch=args.batch, pause=0)
+    finished = time.monotonic()
+
+    millions = args.rows / 1e6
+    print(json.dumps({
+        "rows": args.rows,
+        "batch": args.batch,
+        "seed_seconds": round(seeded - started, 3),
+        "migrate_seconds": round(migrated - seeded, 3),
+        "backfill_seconds": round(finished - migrated, 3),
+        "backfill_seconds_per_million_rows": round((finished - migrated) / millions, 3),
+        "total_seconds_per_million_rows": round((finished - seeded) / millions, 3),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Масштабирование записи по шардам: python bench/bench_shards.py --shards 1,2,4 --processes 4 --duration 10
+# Для каждого числа шардов несколько процессов (как воркеры gunicorn) пополняют кристаллы случайным
+# пользователям через store.add_diamonds; печатает операции в секунду и прирост относительно первого прогона.
+# Запись в SQLite упирается в один пишущий замок на файл, поэтому прирост виден, когда ядер
+# не меньше, чем процессов; DB_SYNCHRONOUS=FULL делает каждую фиксацию дорогой и показывает его и на диске.
+
+
+def shard_env(workdir, shards):
+    paths = [os.path.join(workdir, f'users-{i}.db') for i in range(shards)]
+    env = dict(os.environ, DB_PATH=paths[0], DB_SHARDS=','.join(paths), DB_SHARD_MAP=os.path.join(workdir, 'shards.json'),
+               METRICS_ENABLED='0', SQL_SLOW_MS='0')
+    return env
+
+
+def writer_process(env, users, threads, started, deadline, seed, queue):
+    os.environ.update(env)
+    sys.path.insert(0, APP_DIR)
+    import store
+
+    time.sleep(max(0, started - time.time()))
+    counts = []
+
+    def run(i):
+        rng = random.Random(seed * 1000 + i)
+        done = 0
+        while time.time() < deadline:
+            store.add_diamonds(rng.randint(1, users), 1)
+            done += 1
+        counts.append(done)
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    queue.put(sum(counts))
+
+
+def run(shards, args):
+    workdir = tempfile.mkdtemp(prefix='bench-shards-')
+    env = shard_env(workdir, shards)
+    subprocess.run([sys.executable, '-c', 'import schema; schema.migrate()'], cwd=APP_DIR, env=env, check=True)
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    # Процессам нужно время на импорт приложения; замер начинается одновременно для всех
+    started = time.time() + 2
+    deadline = started + args.duration
+    processes = [context.Process(target=writer_process, args=(env, args.users, args.threads, started, deadline, args.seed + i, queue))
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    operations = sum(queue.get() for _ in processes)
+    for process in processes:
+        process.join()
+    verify = subprocess.run([sys.executable, 'ledger.py', 'verify'], cwd=APP_DIR, env=env, capture_output=True, text=True)
+    return {"shards": shards, "operations": operations, "ops_per_second": round(operations / args.duration, 1),
+            "ledger_ok": verify.returncode == 0}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', default='1,2,4')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    results = [run(int(shards), args) for shards in args.shards.split(',')]
+    base = results[0]["ops_per_second"]
+    for result in results:
+        result["scaling"] = round(result["ops_per_second"] / base, 2) if base else None
+    print(json.dumps({"processes": args.processes, "threads": args.threads, "cpus": os.cpu_count(),
+                      "synchronous": os.getenv("DB_SYNCHRONOUS", "NORMAL"), "results": results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
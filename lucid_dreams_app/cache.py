@@ -0,0 +1,179 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Настройки кэша профилей пользователей
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))
+# local - кэш только внутри процесса, shm - версии ключей общие для всех воркеров gunicorn
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "shm")
+CACHE_SHM_DIR = os.getenv("CACHE_SHM_DIR")
+CACHE_SHM_SLOTS = int(os.getenv("CACHE_SHM_SLOTS", "65536"))
+
+
+# LRU-кэш с ограничением размера и временем жизни записей
+class LRUCache:
+    backend = "local"
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Счетчик изменений: заполнение из БД, начатое до записи, не должно вернуть старое значение
+        self._generation = 0
+
+    # Версия, которую нужно передать в set() после чтения значения из БД
+    def generation(self, key):
+        return self._generation
+
+    def _valid(self, key, version):
+        return True
+
+    def _fill_version(self, key, generation):
+        if generation is not None and generation != self._generation:
+            return False, None
+        return True, None
+
+    def _changed(self, key):
+        self._generation += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires, version = entry
+                if expires > time.monotonic() and self._valid(key, version):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            ok, version = self._fill_version(key, generation)
+            if not ok:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl, version)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    # Обновляет поля закэшированного значения, не продлевая TTL.
+    # Копия, которую уже сделала невалидной запись в другом воркере, не дополняется, а удаляется:
+    # иначе новая версия вернула бы в оборот ее устаревшие поля.
+    def update(self, key, **fields):
+        with self._lock:
+            entry = self._data.get(key)
+            valid = entry is not None and self._valid(key, entry[2])
+            version = self._changed(key)
+            if valid:
+                value, expires, _ = entry
+                self._data[key] = (dict(value, **fields), expires, version)
+            elif entry is not None:
+                del self._data[key]
+
+    def delete(self, key):
+        with self._lock:
+            self._changed(key)
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": self.backend,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Таблица версий ключей в разделяемой памяти (mmap файла), общая для всех процессов на машине.
+# Запись в любом воркере меняет версию ключа, и копии в остальных воркерах перестают быть валидными.
+class SharedVersions:
+    SLOT = struct.Struct("Q")
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        size = slots * self.SLOT.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def _offset(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+        return (int.from_bytes(digest, "little") % self.slots) * self.SLOT.size
+
+    def get(self, key):
+        return self.SLOT.unpack_from(self._map, self._offset(key))[0]
+
+    # Случайная новая версия вместо инкремента: не нужна межпроцессная блокировка
+    def bump(self, key):
+        version = int.from_bytes(os.urandom(8), "little")
+        self.SLOT.pack_into(self._map, self._offset(key), version)
+        return version
+
+
+# Локальные копии значений с проверкой версии ключа в разделяемой памяти
+class SharedCache(LRUCache):
+    backend = "shm"
+
+    def __init__(self, maxsize, ttl, versions):
+        super().__init__(maxsize, ttl)
+        self.versions = versions
+
+    def generation(self, key):
+        return self.versions.get(key)
+
+    def _valid(self, key, version):
+        return version == self.versions.get(key)
+
+    def _fill_version(self, key, generation):
+        return True, self.versions.get(key) if generation is None else generation
+
+    def _changed(self, key):
+        return self.versions.bump(key)
+
+
+def default_shm_path(name):
+    directory = CACHE_SHM_DIR or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+    # Отдельный файл на каждую базу, чтобы разные копии приложения не мешали друг другу
+    db = os.path.abspath(os.getenv("DB_PATH", "users.db"))
+    suffix = hashlib.blake2b(db.encode(), digest_size=6).hexdigest()
+    return os.path.join(directory, f"lucid_dreams-{name}-{suffix}.versions")
+
+
+def make_cache(name, maxsize, ttl):
+    if CACHE_BACKEND == "local":
+        return LRUCache(maxsize, ttl)
+    if CACHE_BACKEND == "shm":
+        return SharedCache(maxsize, ttl, SharedVersions(default_shm_path(name), CACHE_SHM_SLOTS))
+    raise ValueError(f"unknown CACHE_BACKEND: {CACHE_BACKEND}")
+
+
+profiles = make_cache("profiles", PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
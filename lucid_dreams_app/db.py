@@ -0,0 +1,439 @@
+import asyncio
+import contextvars
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from time import perf_counter
+
+import metrics
+import querylog
+import sharding
+
+logger = logging.getLogger(__name__)
+
+# Настройки пула соединений с SQLite
+DB_PATH = sharding.DB_PATH
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# Соединение, простоявшее дольше этого времени, проверяется перед выдачей
+DB_HEALTHCHECK_INTERVAL = float(os.getenv("DB_HEALTHCHECK_INTERVAL", "30"))
+# Размер кэша подготовленных выражений на соединение
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "128"))
+
+# Режим хранения: WAL позволяет читателям не ждать писателя
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "wal")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))
+DB_MMAP_BYTES = int(os.getenv("DB_MMAP_BYTES", str(256 * 1024 * 1024)))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# Запись через отдельный поток с групповыми коммитами
+DB_WRITE_QUEUE = os.getenv("DB_WRITE_QUEUE", "1") == "1"
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "64"))
+DB_WRITE_LINGER = float(os.getenv("DB_WRITE_LINGER_MS", "2")) / 1000
+# Сколько запрос ждет результата записи из очереди, прежде чем сдаться
+DB_WRITE_TIMEOUT = float(os.getenv("DB_WRITE_TIMEOUT", "30"))
+# Пауза перед повторным открытием базы, если поток-писатель не смог ее открыть
+DB_WRITER_RETRY = 1.0
+
+# RETURNING появился в SQLite 3.35; на старых версиях результат читается отдельным запросом в той же транзакции
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+def configure(conn):
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_BYTES}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+
+# journal_mode хранится в самом файле, достаточно выставить один раз
+def set_journal_mode(conn):
+    conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+
+
+# Соединение, которое учитывает каждое выражение в метриках текущего запроса
+# и передает медленные (или, при проверке планов, новые) выражения в журнал querylog
+class InstrumentedConnection(sqlite3.Connection):
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        # Файл базы: по нему querylog различает одноименные таблицы разных шардов
+        self.path = os.path.abspath(database)
+
+    def execute(self, sql, parameters=()):
+        started = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            seconds = perf_counter() - started
+            metrics.record_sql(seconds)
+            if seconds >= querylog.SQL_SLOW_SECONDS or querylog.SQL_SCAN_CHECK != 'off':
+                querylog.observe(self, sql, parameters, seconds)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            seconds = perf_counter() - started
+            metrics.record_sql(seconds)
+            if seconds >= querylog.SQL_SLOW_SECONDS:
+                querylog.observe(self, sql, None, seconds)
+
+
+# Без метрик и журнала медленных запросов соединение обычное, чтобы не платить за обертку
+CONNECTION_FACTORY = InstrumentedConnection if metrics.METRICS_ENABLED or querylog.SQL_SLOW_MS > 0 else sqlite3.Connection
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, path, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    # После fork (gunicorn --preload) соединения родителя использовать нельзя
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._local = threading.local()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+            factory=CONNECTION_FACTORY,
+        )
+        configure(conn)
+        return conn
+
+    def _healthy(self, conn, idle_since):
+        if time.monotonic() - idle_since < DB_HEALTHCHECK_INTERVAL:
+            return True
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _acquire(self):
+        self._check_pid()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"no free SQLite connection for {self.path}")
+        try:
+            while True:
+                try:
+                    conn, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._healthy(conn, idle_since):
+                    return conn
+                conn.close()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, conn, broken=False):
+        if broken:
+            conn.close()
+        else:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put((conn, time.monotonic()))
+        self._slots.release()
+
+    # Выдает соединение из пула; вложенные вызовы в том же потоке получают то же соединение
+    @contextmanager
+    def connection(self):
+        self._check_pid()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        with metrics.phase("db_connect"):
+            conn = self._acquire()
+        self._local.conn = conn
+        broken = False
+        try:
+            yield conn
+        except sqlite3.Error as e:
+            # Соединение выбрасываем только при повреждении, а не при ошибках запроса
+            broken = type(e) in (sqlite3.DatabaseError, sqlite3.InterfaceError)
+            raise
+        finally:
+            self._local.conn = None
+            self._release(conn, broken)
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+
+class Writer:
+    def __init__(self, path, batch=DB_WRITE_BATCH, linger=DB_WRITE_LINGER):
+        self.path = path
+        self.batch = batch
+        self.linger = linger
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            thread = threading.Thread(target=self._run, args=(self._queue,), name="sqlite-writer", daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    # Ставит fn(conn) в очередь записи; fn не должна сама делать commit.
+    # fn выполняется в контексте вызывающего, чтобы ее SQL учитывался в метриках его запроса.
+    def submit(self, fn):
+        if self._pid != os.getpid():
+            self._start()
+        future = Future()
+        self._queue.put((contextvars.copy_context(), fn, future))
+        return future
+
+    def _collect(self, jobs):
+        first = jobs.get()
+        batch = [first]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(jobs.get(timeout=timeout) if timeout > 0 else jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=DB_STATEMENT_CACHE,
+                               factory=CONNECTION_FACTORY)
+        try:
+            configure(conn)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    # Пачка не записана: все ее задания, которые еще не завершены, получают ошибку.
+    # Задания, которые не успели начаться, тоже, иначе их ждали бы вечно.
+    @staticmethod
+    def _fail(batch, error):
+        for _, _, future in batch:
+            if future.done():
+                continue
+            if future.running() or future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+    def _run(self, jobs):
+        conn = None
+        while True:
+            batch = self._collect(jobs)
+            started = perf_counter()
+            done = []
+            try:
+                if conn is None:
+                    conn = self._connect()
+                conn.execute("BEGIN IMMEDIATE")
+                for context, fn, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    # Ошибка одного задания не откатывает остальные задания пачки
+                    conn.execute("SAVEPOINT job")
+                    try:
+                        result = context.run(fn, conn)
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO job")
+                        conn.execute("RELEASE job")
+                        future.set_exception(e)
+                    else:
+                        conn.execute("RELEASE job")
+                        done.append((future, result))
+                with metrics.timed("sqlite_write_commit_seconds"):
+                    conn.execute("COMMIT")
+            except Exception as e:
+                self._fail(batch, e)
+                if conn is None:
+                    logger.exception("sqlite writer could not open %s", self.path)
+                    time.sleep(DB_WRITER_RETRY)
+                    continue
+                try:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                except sqlite3.Error:
+                    # Соединение в неизвестном состоянии: следующая пачка откроет новое
+                    logger.exception("sqlite writer rollback failed on %s, reconnecting", self.path)
+                    try:
+                        conn.close()
+                    except sqlite3.Error:
+                        pass
+                    conn = None
+                continue
+            metrics.observe("sqlite_write_batch_seconds", perf_counter() - started)
+            for future, result in done:
+                future.set_result(result)
+
+
+# Один файл SQLite: свой пул соединений и свой поток-писатель, поэтому шарды пишут независимо
+class Shard:
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.pool = ConnectionPool(path)
+        self.writer = Writer(path)
+
+    def connection(self):
+        return self.pool.connection()
+
+    # Выполняет fn(conn) в пишущей транзакции и возвращает ее результат
+    def write(self, fn):
+        if DB_WRITE_QUEUE:
+            future = self.writer.submit(fn)
+            with metrics.phase("db_write"):
+                try:
+                    return future.result(DB_WRITE_TIMEOUT)
+                except FutureTimeout:
+                    # Задание, которое еще не начато, уже не выполнится
+                    future.cancel()
+                    raise
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn)
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            return result
+
+    # Запись ждет результата от потока-писателя, не занимая поток executor
+    async def write_async(self, fn):
+        if DB_WRITE_QUEUE:
+            with metrics.phase("db_write"):
+                return await asyncio.wait_for(asyncio.wrap_future(self.writer.submit(fn)), DB_WRITE_TIMEOUT)
+        return await run_async(self.write, fn)
+
+
+# Пользователь уже переехал на другой шард (или создается сразу там) во время решардинга
+class Moved(Exception):
+    def __init__(self, shard):
+        super().__init__(f"user moved to shard {shard}")
+        self.shard = shard
+
+
+_shards = {}
+_shards_lock = threading.Lock()
+# Потоки для блокирующих обращений к SQLite из асинхронного кода, по одному на соединение пула
+executor = ThreadPoolExecutor(DB_POOL_SIZE, thread_name_prefix="sqlite-async")
+
+
+def shard_at(name, path):
+    key = os.path.abspath(path)
+    shard = _shards.get(key)
+    if shard is None:
+        with _shards_lock:
+            shard = _shards.get(key)
+            if shard is None:
+                shard = _shards[key] = Shard(name, path)
+    return shard
+
+
+def shard(name):
+    return shard_at(name, sharding.current().paths[name])
+
+
+# Все шарды текущей раскладки, включая добавляемые при решардинге
+def shards():
+    return [shard_at(name, path) for name, path in sharding.current().paths.items()]
+
+
+# Шард пользователя и, если во время решардинга пользователь должен уехать, имя нового шарда
+def route(user_id):
+    shard_map = sharding.current()
+    name = shard_map.ring.owner(user_id)
+    moving_to = None
+    if shard_map.target is not None:
+        target = shard_map.target.owner(user_id)
+        if target != name:
+            moving_to = target
+    return shard(name), moving_to
+
+
+# Пока идет решардинг, отсутствие пользователя на старом шарде значит, что он уже переехал
+# (или новый и создается сразу на целевом). reshard.py переносит пользователя и удаляет его
+# со старого шарда в одной пишущей транзакции, поэтому проверка внутри транзакции надежна.
+def _present(conn, user_id):
+    return conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+
+def _fenced(fn, user_id, moving_to):
+    if moving_to is None:
+        return fn
+
+    def run(conn):
+        if not _present(conn, user_id):
+            raise Moved(moving_to)
+        return fn(conn)
+    return run
+
+
+# Запись для одного пользователя: вся транзакция идет на его шарде
+def write(fn, user_id):
+    shard_, moving_to = route(user_id)
+    try:
+        return shard_.write(_fenced(fn, user_id, moving_to))
+    except Moved as e:
+        return shard(e.shard).write(fn)
+
+
+async def write_async(fn, user_id):
+    shard_, moving_to = route(user_id)
+    try:
+        return await shard_.write_async(_fenced(fn, user_id, moving_to))
+    except Moved as e:
+        return await shard(e.shard).write_async(fn)
+
+
+# Чтение для одного пользователя: fn(conn) на его шарде. Проверка переезда идет после чтения:
+# если пользователь еще на месте, прочитанное было актуальным.
+def read(fn, user_id):
+    shard_, moving_to = route(user_id)
+    with shard_.connection() as conn:
+        result = fn(conn)
+        if moving_to is None or _present(conn, user_id):
+            return result
+    with shard(moving_to).connection() as conn:
+        return fn(conn)
+
+
+# Асинхронный доступ: чтение выполняется в потоке executor, event loop не блокируется
+# Контекст копируется, чтобы SQL из потока executor попадал в метрики текущего запроса
+async def run_async(fn, *args):
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, fn, *args)
@@ -0,0 +1,94 @@
+import os
+import time
+
+from cache import profiles as cache
+from db import HAS_RETURNING, write, write_async
+
+# Энергия восстанавливается на 1 единицу каждые ENERGY_REGEN_SECONDS секунд до ENERGY_MAX.
+# В базе лежат energy_at (значение на момент energy_updated_ts) и energy_updated_ts;
+# текущее значение вычисляется при чтении, запись происходит только при трате.
+ENERGY_MAX = int(os.getenv("ENERGY_MAX", "100"))
+ENERGY_REGEN_SECONDS = int(os.getenv("ENERGY_REGEN_SECONDS", "360"))
+
+
+def _regenerated(energy_at, updated_ts, now):
+    return energy_at + max(0, now - updated_ts) // ENERGY_REGEN_SECONDS
+
+
+# Текущая энергия; бонусы сверх максимума не срезаются
+def current(energy_at, updated_ts, now=None):
+    now = int(time.time()) if now is None else now
+    if energy_at >= ENERGY_MAX:
+        return energy_at
+    return min(ENERGY_MAX, _regenerated(energy_at, updated_ts, now))
+
+
+# Секунд до следующей единицы энергии или None, если энергия полная
+def seconds_to_next(energy_at, updated_ts, now=None):
+    now = int(time.time()) if now is None else now
+    if current(energy_at, updated_ts, now) >= ENERGY_MAX:
+        return None
+    return ENERGY_REGEN_SECONDS - max(0, now - updated_ts) % ENERGY_REGEN_SECONDS
+
+
+# Восстановленная энергия считается в самом UPDATE; накопленная часть неполной единицы сохраняется,
+# сдвигая energy_updated_ts только на целое число интервалов
+_GAINED = "energy_at + max(0, :now - energy_updated_ts) / :regen"
+_CURRENT = f"max(energy_at, min(:max, {_GAINED}))"
+SPEND_SQL = f'''UPDATE users SET
+    energy_at = {_CURRENT} - :amount,
+    energy_updated_ts = CASE WHEN {_GAINED} >= :max THEN :now
+                             ELSE energy_updated_ts + max(0, :now - energy_updated_ts) / :regen * :regen END
+    WHERE user_id = :user_id AND {_CURRENT} >= :amount'''
+if HAS_RETURNING:
+    SPEND_SQL += " RETURNING energy_at, energy_updated_ts"
+
+
+def _spend(conn, params):
+    cursor = conn.execute(SPEND_SQL, params)
+    if HAS_RETURNING:
+        rows = cursor.fetchall()
+        return rows[0] if rows else None
+    if cursor.rowcount == 0:
+        return None
+    return conn.execute("SELECT energy_at, energy_updated_ts FROM users WHERE user_id = ?", (params['user_id'],)).fetchone()
+
+
+def _spend_job(user_id, amount):
+    params = {"user_id": user_id, "amount": amount, "now": int(time.time()), "max": ENERGY_MAX, "regen": ENERGY_REGEN_SECONDS}
+
+    def job(conn):
+        row = _spend(conn, params)
+        if row is None and conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,)).rowcount:
+            row = _spend(conn, params)
+        return row
+    return job
+
+
+def _amount(amount):
+    # int() молча отбросил бы дробную часть
+    if isinstance(amount, float) and not amount.is_integer():
+        raise ValueError("energy amount must be an integer")
+    amount = int(amount)
+    if amount <= 0:
+        raise ValueError("energy amount must be positive")
+    return amount
+
+
+def _remember(user_id, row):
+    if row is None:
+        return None
+    energy_at, updated_ts = row
+    cache.update(user_id, energy_at=energy_at, energy_updated_ts=updated_ts)
+    return current(energy_at, updated_ts)
+
+
+# Трата энергии; возвращает оставшуюся энергию или None, если ее не хватает
+def spend(user_id, amount):
+    user_id = int(user_id)
+    return _remember(user_id, write(_spend_job(user_id, _amount(amount)), user_id))
+
+
+async def spend_async(user_id, amount):
+    user_id = int(user_id)
+    return _remember(user_id, await write_async(_spend_job(user_id, _amount(amount)), user_id))
@@ -0,0 +1,103 @@
+import hashlib
+import html
+import json
+import os
+import re
+
+import shell
+
+I18N_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'i18n')
+
+# Языки в том порядке, в котором они показаны в настройках, и файлы их переводов
+LANGUAGES = {
+    'Русский': 'ru',
+    'English': 'en',
+    'Français': 'fr',
+    'Italiano': 'it',
+    'Deutsch': 'de',
+    'Español': 'es',
+}
+DEFAULT_LANGUAGE = 'Русский'
+
+
+def load_catalog():
+    catalog = {}
+    for language, code in LANGUAGES.items():
+        path = os.path.join(I18N_DIR, f'{code}.json')
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                catalog[language] = json.load(f)
+    return catalog
+
+
+# Переводы загружаются один раз при старте
+CATALOG = load_catalog()
+VERSIONS = {
+    language: hashlib.sha256(json.dumps(strings, sort_keys=True).encode()).hexdigest()[:12]
+    for language, strings in CATALOG.items()
+}
+
+
+# Язык, для которого есть переводы; для остальных используется язык по умолчанию
+def resolve(language):
+    return language if language in CATALOG else DEFAULT_LANGUAGE
+
+
+def strings(language):
+    return CATALOG[resolve(language)]
+
+
+def version(language):
+    return VERSIONS[resolve(language)]
+
+
+# Готовые сжатые пакеты переводов, по одному на язык; адрес содержит версию, поэтому пакет кэшируется навсегда
+BUNDLES = {
+    language: shell.Shell(json.dumps(strings, ensure_ascii=False, sort_keys=True))
+    for language, strings in CATALOG.items()
+}
+BUNDLE_PATHS = {f'{LANGUAGES[language]}.{VERSIONS[language]}.json': bundle for language, bundle in BUNDLES.items()}
+
+
+def bundle_url(language):
+    language = resolve(language)
+    return f'/i18n/{LANGUAGES[language]}.{VERSIONS[language]}.json'
+
+
+def find_bundle(path):
+    return BUNDLE_PATHS.get(path)
+
+
+# Язык страницы: из cookie language (код языка), иначе лучший из Accept-Language, иначе язык по умолчанию
+def negotiate(cookie, accept_languages):
+    codes = {LANGUAGES[language]: language for language in CATALOG}
+    if cookie in codes:
+        return codes[cookie]
+    best = accept_languages.best_match(list(codes)) if accept_languages else None
+    return codes.get(best, DEFAULT_LANGUAGE)
+
+
+_TRANSLATABLE = re.compile(r'(<(\w+)\b[^>]*\sdata-i18n="(\w+)"[^>]*>)([^<]*)(</\2>)')
+
+
+# Преобразование разметки для одного языка: тексты элементов с data-i18n заменяются переводом,
+# в скрипт попадают только строки этого языка, а для остальных языков - код и адрес пакета
+def localize(language):
+    language = resolve(language)
+    catalog = CATALOG[language]
+
+    def translate(match):
+        text = catalog.get(match.group(3))
+        if text is None:
+            return match.group(0)
+        return match.group(1) + html.escape(text, quote=False) + match.group(5)
+
+    def transform(page):
+        page = _TRANSLATABLE.sub(translate, page)
+        page = page.replace('<html lang="ru">', f'<html lang="{LANGUAGES[language]}">', 1)
+        page = page.replace(f'<span id="lang-{language}" style="display: none;">', f'<span id="lang-{language}" style="display: inline;">', 1)
+        page = page.replace('{{language}}', shell.script_json(language))
+        page = page.replace('{{strings}}', shell.script_json(catalog))
+        bundles = {name: {"code": code, "url": bundle_url(name)} for name, code in LANGUAGES.items()}
+        return page.replace('{{i18n_bundles}}', shell.script_json(bundles))
+    return transform
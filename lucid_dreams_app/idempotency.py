@@ -0,0 +1,51 @@
+import hashlib
+import itertools
+import os
+import time
+
+# Повтор запроса с тем же ключом в течение IDEMPOTENCY_TTL секунд возвращает сохраненный результат
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+# Устаревшие ключи удаляются порциями после каждых IDEMPOTENCY_EVICT_EVERY новых ключей
+IDEMPOTENCY_EVICT_EVERY = int(os.getenv("IDEMPOTENCY_EVICT_EVERY", "1000"))
+IDEMPOTENCY_EVICT_BATCH = 1000
+
+_stored = itertools.count(1)
+
+
+# Тот же ключ повторно использован с другими параметрами запроса
+class Conflict(Exception):
+    pass
+
+
+# Ключ клиента привязывается к пользователю и операции и хранится как 16 байт хэша
+def make_key(user_id, operation, client_key):
+    if not client_key:
+        return None
+    return hashlib.sha256(f'{user_id}:{operation}:{client_key}'.encode()).digest()[:16]
+
+
+def _evict(conn, now):
+    conn.execute('''DELETE FROM idempotency WHERE key IN
+                    (SELECT key FROM idempotency WHERE created_at < ? LIMIT ?)''', (now - IDEMPOTENCY_TTL, IDEMPOTENCY_EVICT_BATCH))
+
+
+# Оборачивает задание записи: проверка ключа, выполнение и сохранение результата идут в одной транзакции.
+# Новое задание возвращает (результат, False), повтор - (сохраненный результат, True), не трогая users.
+def wrap(job, key, request, user_id):
+    if key is None:
+        return lambda conn: (job(conn), False)
+
+    def run(conn):
+        now = int(time.time())
+        row = conn.execute("SELECT request, result, created_at FROM idempotency WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[2] >= now - IDEMPOTENCY_TTL:
+            if row[0] != request:
+                raise Conflict("idempotency key reused with different parameters")
+            return row[1], True
+        result = job(conn)
+        conn.execute("INSERT OR REPLACE INTO idempotency (key, request, result, created_at, user_id) VALUES (?, ?, ?, ?, ?)",
+                     (key, request, result, now, user_id))
+        if next(_stored) % IDEMPOTENCY_EVICT_EVERY == 0:
+            _evict(conn, now)
+        return result, False
+    return run
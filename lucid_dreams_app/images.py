@@ -0,0 +1,201 @@
+import fcntl
+import hashlib
+import os
+import re
+import sys
+import threading
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGES_DIR = os.path.join(APP_DIR, 'static', 'images')
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(APP_DIR, '.image_cache'))
+
+# Размеры, в которых картинки показываются на странице /webapp (CSS-пиксели, ширина x высота)
+TAB_ICON = (36, 36)          # .tab img
+CURRENCY_ICON = (24, 24)     # .currency img
+CHARACTER_CARD = (160, 240)  # .character-card img, object-fit: cover
+ITEM_CARD = (140, 140)       # .item-card img
+DIAMOND_CARD = (120, 120)    # .diamond-card img
+STORY_CARD = (480, None)     # .story-card img, ширина 100% экрана телефона
+
+DISPLAY_SIZES = {
+    'character.png': TAB_ICON, 'store.png': TAB_ICON, 'settings.png': TAB_ICON,
+    'diamond.png': CURRENCY_ICON, 'energy.png': CURRENCY_ICON,
+    'nika.png': CHARACTER_CARD, 'teta.png': CHARACTER_CARD, 'sa.png': CHARACTER_CARD, 'rik.png': CHARACTER_CARD,
+    'pajamas.png': ITEM_CARD, 'lingerie.png': ITEM_CARD, 'cat_ears.png': ITEM_CARD, 'vip_pass.png': ITEM_CARD,
+    'wine_bottle.png': ITEM_CARD, 'control_charm.png': ITEM_CARD, 'flower_bouquet.png': ITEM_CARD,
+    'diamonds_85.png': DIAMOND_CARD, 'diamonds_210.png': DIAMOND_CARD, 'diamonds_540.png': DIAMOND_CARD,
+    'diamonds_1360.png': DIAMOND_CARD, 'diamonds_2720.png': DIAMOND_CARD, 'diamonds_5000.png': DIAMOND_CARD,
+    '1.png': STORY_CARD, '2.png': STORY_CARD, '3.png': STORY_CARD, '4.png': STORY_CARD,
+}
+# Плотности экрана, для которых готовятся варианты (1x и 2x в srcset)
+DENSITIES = (1, 2)
+
+# Форматы в порядке предпочтения: mime-тип, расширение, параметры сохранения
+FORMATS = [
+    ('image/avif', 'avif', {'quality': 55, 'speed': 6}),
+    ('image/webp', 'webp', {'quality': 80, 'method': 4}),
+    ('image/png', 'png', {'optimize': True}),
+]
+
+
+def _supported(ext):
+    if ext == 'png':
+        return True
+    return Image is not None and features.check(ext)
+
+
+FORMATS = [f for f in FORMATS if _supported(f[1])]
+
+
+# Ширина варианта, которой хватает, чтобы покрыть блок с учетом object-fit: cover
+def cover_width(source_size, box):
+    src_w, src_h = source_size
+    box_w, box_h = box
+    if box_h is None:
+        return box_w
+    return max(box_w, -(-box_h * src_w // src_h))
+
+
+class Source:
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        with open(path, 'rb') as f:
+            self.digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        with Image.open(path) as im:
+            self.size = im.size
+        base = cover_width(self.size, DISPLAY_SIZES[name])
+        # Картинки меньше нужного размера не увеличиваем: отдаем оригинал, а 2x ограничиваем шириной исходника
+        if base < self.size[0]:
+            self.widths = sorted({min(base * d, self.size[0]) for d in DENSITIES})
+        else:
+            self.widths = []
+
+    # Хэш исходника в адресе делает его неизменяемым
+    def url(self, width):
+        return f'/images/{width}/{self.digest}/{self.name}'
+
+    def cache_path(self, width, ext):
+        stem = os.path.splitext(self.name)[0]
+        return os.path.join(IMAGE_CACHE_DIR, f'{stem}-{self.digest}-{width}.{ext}')
+
+
+def scan():
+    sources = {}
+    if Image is None:
+        return sources
+    for name in DISPLAY_SIZES:
+        path = os.path.join(IMAGES_DIR, name)
+        if os.path.exists(path):
+            source = Source(name, path)
+            if source.widths:
+                sources[name] = source
+    return sources
+
+
+SOURCES = scan()
+_build_lock = threading.Lock()
+
+
+def build(source, width, fmt):
+    _, ext, options = fmt
+    path = source.cache_path(width, ext)
+    if os.path.exists(path):
+        return path
+    with _build_lock:
+        if os.path.exists(path):
+            return path
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        with Image.open(source.path) as im:
+            height = round(im.height * width / im.width)
+            resized = im.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+        # Пишем во временный файл и переименовываем, чтобы другие воркеры не прочли половину файла
+        tmp = f'{path}.{os.getpid()}.tmp'
+        resized.save(tmp, ext.upper(), **options)
+        os.replace(tmp, path)
+    return path
+
+
+# Лучший формат из поддерживаемых клиентом по заголовку Accept
+def choose_format(accept):
+    # Учитываем только явно перечисленные типы: image/* не значит, что браузер умеет AVIF
+    listed = {value for value, quality in accept if quality > 0}
+    for fmt in FORMATS:
+        if fmt[0] in listed:
+            return fmt
+    return FORMATS[-1]
+
+
+def find(width, digest, name):
+    source = SOURCES.get(name)
+    if source is None or width not in source.widths or digest != source.digest:
+        return None
+    return source
+
+
+IMG_TAG = re.compile(r'<img src="/static/images/([^"]+)"')
+STATIC_URL = re.compile(r"/static/images/([^\"']+)")
+
+
+def _img_tag(match):
+    source = SOURCES.get(match.group(1))
+    if source is None:
+        return match.group(0)
+    srcset = ', '.join(f'{source.url(w)} {round(w / source.widths[0], 2):g}x' for w in source.widths)
+    return f'<img src="{source.url(source.widths[0])}" srcset="{srcset}"'
+
+
+def _static_url(match):
+    source = SOURCES.get(match.group(1))
+    if source is None:
+        return match.group(0)
+    return source.url(source.widths[-1])
+
+
+# Заменяет ссылки на оригиналы в разметке ссылками на уменьшенные варианты
+def rewrite(html):
+    html = IMG_TAG.sub(_img_tag, html)
+    # Ссылки внутри скрипта (картинки историй) получают самый крупный вариант
+    return STATIC_URL.sub(_static_url, html)
+
+
+def build_all(verbose=False):
+    for source in SOURCES.values():
+        for width in source.widths:
+            for fmt in FORMATS:
+                path = build(source, width, fmt)
+                if verbose:
+                    print(f'{source.name} {width}px {fmt[1]}: {os.path.getsize(path)} bytes')
+
+
+def _warm(lock_file):
+    try:
+        build_all()
+    finally:
+        lock_file.close()
+
+
+# Фоновая сборка при старте; flock гарантирует, что собирает только один воркер
+def warm_in_background():
+    if not SOURCES:
+        return
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    lock_file = open(os.path.join(IMAGE_CACHE_DIR, '.build.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return
+    threading.Thread(target=_warm, args=(lock_file,), name='image-warmup', daemon=True).start()
+
+
+# Сборка всех вариантов заранее: python images.py
+if __name__ == '__main__':
+    if Image is None:
+        sys.exit('Pillow is not installed')
+    build_all(verbose=True)
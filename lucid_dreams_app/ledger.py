@@ -0,0 +1,212 @@
+import argparse
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Контрольные точки балансов: раз в LEDGER_CHECKPOINT_INTERVAL секунд хвост журнала
+# после прошлой точки сворачивается в balance_snapshots порциями по LEDGER_CHECKPOINT_BATCH строк
+LEDGER_CHECKPOINT_INTERVAL = float(os.getenv("LEDGER_CHECKPOINT_INTERVAL", "300"))
+LEDGER_CHECKPOINT_BATCH = int(os.getenv("LEDGER_CHECKPOINT_BATCH", "50000"))
+# Сколько строк журнала читать за раз при проверке
+LEDGER_VERIFY_CHUNK = 10000
+
+
+# Добавляет запись в журнал; вызывается внутри пишущей транзакции, которая меняет users.diamonds.
+# Записи пишутся через поток-писатель, поэтому попадают в базу пачками с одним COMMIT.
+def append(conn, user_id, delta, reason, ref=None):
+    conn.execute("INSERT INTO ledger (user_id, delta, reason, ref, created_at) VALUES (?, ?, ?, ?, ?)",
+                 (user_id, delta, reason, ref, int(time.time())))
+
+
+def last_checkpoint(conn):
+    return conn.execute("SELECT coalesce(max(ledger_id), 0) FROM ledger_checkpoints").fetchone()[0]
+
+
+# Сворачивает в снимок следующую порцию хвоста журнала; возвращает True, если хвост еще остался
+def _checkpoint_step(conn, batch):
+    last = last_checkpoint(conn)
+    top = conn.execute("SELECT coalesce(max(id), 0) FROM ledger").fetchone()[0]
+    if top <= last:
+        return False
+    # Порция - диапазон id. id журнала только растут (AUTOINCREMENT, см. schema.ledger_autoincrement):
+    # reshard.py удаляет записи переехавших пользователей, но их id не выдаются повторно,
+    # поэтому новые записи всегда выше контрольной точки. Пропуски в диапазоне не мешают.
+    upper = min(top, last + batch)
+    conn.execute('''INSERT INTO balance_snapshots (user_id, diamonds)
+                    SELECT user_id, SUM(delta) FROM ledger WHERE id > ? AND id <= ? GROUP BY user_id
+                    ON CONFLICT(user_id) DO UPDATE SET diamonds = diamonds + excluded.diamonds''', (last, upper))
+    conn.execute("INSERT INTO ledger_checkpoints (ledger_id, created_at) VALUES (?, ?)", (upper, int(time.time())))
+    return upper < top
+
+
+# Контрольные точки у каждого шарда свои: id журнала независимы в каждом файле
+def checkpoint(batch=LEDGER_CHECKPOINT_BATCH):
+    for shard in db.shards():
+        while shard.write(lambda conn: _checkpoint_step(conn, batch)):
+            pass
+
+
+# Пересчитывает users.diamonds из снимка и хвоста журнала после контрольной точки.
+# Кэш профилей в работающих воркерах обновится по истечении TTL.
+REBUILD_SQL = '''UPDATE users SET diamonds =
+                     coalesce((SELECT diamonds FROM balance_snapshots s WHERE s.user_id = users.user_id), 0)
+                     + coalesce((SELECT SUM(delta) FROM ledger l WHERE l.user_id = users.user_id AND l.id > ?), 0)'''
+
+
+# Пока идет заполнение ledger_opening, журнал не содержит балансов, появившихся до него
+class OpeningPending(Exception):
+    pass
+
+
+def _opening_pending(conn):
+    return conn.execute("SELECT 1 FROM backfills WHERE name = 'ledger_opening' AND done = 0").fetchone() is not None
+
+
+# Пересчет до окончания ledger_opening обнулил бы старые балансы, и заполнению стало бы нечего открывать.
+# Проверка идет в той же пишущей транзакции, что и пересчет.
+def _rebuild_job(sql, params):
+    def job(conn):
+        if _opening_pending(conn):
+            raise OpeningPending("ledger_opening backfill is not finished; rebuild would zero older balances")
+        return conn.execute(sql, (last_checkpoint(conn),) + params).rowcount
+    return job
+
+
+def rebuild(user_ids=None):
+    if user_ids is None:
+        return sum(shard.write(_rebuild_job(REBUILD_SQL, ())) for shard in db.shards())
+    return sum(db.write(_rebuild_job(REBUILD_SQL + " WHERE user_id = ?", (user_id,)), user_id) for user_id in user_ids)
+
+
+def _stream(conn, sql, params=()):
+    cursor = conn.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(LEDGER_VERIFY_CHUNK)
+        if not rows:
+            return
+        yield from rows
+
+
+def _compare(expected, actual_rows, limit):
+    mismatches = []
+    seen = set()
+    for user_id, diamonds in actual_rows:
+        seen.add(user_id)
+        if expected.get(user_id, 0) != (diamonds or 0) and len(mismatches) < limit:
+            mismatches.append({"user_id": user_id, "ledger": expected.get(user_id, 0), "stored": diamonds})
+    for user_id, balance in expected.items():
+        if user_id not in seen and balance and len(mismatches) < limit:
+            mismatches.append({"user_id": user_id, "ledger": balance, "stored": None})
+    return mismatches
+
+
+# Проверка за один проход по журналу в порядке id: балансы на контрольной точке сверяются
+# со снимком, итоговые - с users.diamonds; отрицательный промежуточный баланс тоже ошибка.
+# Покупка во время ledger_opening может попасть в журнал раньше начальной записи пользователя
+# (open_ledger вычитает ее из начальной суммы), поэтому до начальной записи минус не считается ошибкой.
+# Все чтения идут в одной транзакции, то есть по согласованному состоянию шарда.
+def verify_shard(shard, limit=20):
+    started = time.monotonic()
+    with shard.connection() as conn:
+        conn.execute("BEGIN")
+        try:
+            since = last_checkpoint(conn)
+            balances = {}
+            negative = []
+            rows = 0
+            snapshot_mismatches = None
+            opening = dict(conn.execute("SELECT user_id, min(id) FROM ledger WHERE reason = 'opening' GROUP BY user_id"))
+            for ledger_id, user_id, delta in _stream(conn, "SELECT id, user_id, delta FROM ledger ORDER BY id"):
+                if snapshot_mismatches is None and ledger_id > since:
+                    snapshot_mismatches = _compare(balances, _stream(conn, "SELECT user_id, diamonds FROM balance_snapshots"), limit)
+                rows += 1
+                balance = balances.get(user_id, 0) + delta
+                balances[user_id] = balance
+                if balance < 0 and opening.get(user_id, 0) < ledger_id and len(negative) < limit:
+                    negative.append({"ledger_id": ledger_id, "user_id": user_id, "balance": balance})
+            if snapshot_mismatches is None:
+                snapshot_mismatches = _compare(balances, _stream(conn, "SELECT user_id, diamonds FROM balance_snapshots"), limit)
+            balance_mismatches = _compare(balances, _stream(conn, "SELECT user_id, diamonds FROM users"), limit)
+            pending = _opening_pending(conn)
+        finally:
+            conn.rollback()
+    seconds = time.monotonic() - started
+    return {
+        "ok": not (negative or snapshot_mismatches or balance_mismatches or pending),
+        "rows": rows,
+        "users": len(balances),
+        "checkpoint": since,
+        "opening_backfill_pending": pending,
+        "negative": negative,
+        "snapshot_mismatches": snapshot_mismatches,
+        "balance_mismatches": balance_mismatches,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds) if seconds else None,
+    }
+
+
+def verify(limit=20):
+    reports = {shard.name: verify_shard(shard, limit) for shard in db.shards()}
+    return {"ok": all(report["ok"] for report in reports.values()), "shards": reports}
+
+
+_checkpoint_lock = None
+
+
+# Контрольные точки делает один воркер; блокировка снимается ОС при завершении процесса
+def _run_checkpoints(lock_path):
+    global _checkpoint_lock
+    lock_file = open(lock_path, 'w')
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except OSError:
+            time.sleep(LEDGER_CHECKPOINT_INTERVAL)
+    _checkpoint_lock = lock_file
+    while True:
+        time.sleep(LEDGER_CHECKPOINT_INTERVAL)
+        try:
+            checkpoint()
+        except Exception:
+            logger.exception("ledger checkpoint failed")
+
+
+def start_checkpoints():
+    lock_path = os.path.abspath(db.DB_PATH) + '.ledger.lock'
+    threading.Thread(target=_run_checkpoints, args=(lock_path,), name="ledger-checkpoints", daemon=True).start()
+
+
+# python ledger.py verify | checkpoint | rebuild [user_id ...]
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['verify', 'checkpoint', 'rebuild'])
+    parser.add_argument('user_ids', nargs='*', type=int)
+    args = parser.parse_args()
+    if args.command == 'verify':
+        report = verify()
+        print(json.dumps(report, indent=2))
+        raise SystemExit(0 if report["ok"] else 1)
+    if args.command == 'checkpoint':
+        checkpoint()
+        checkpoints = {}
+        for shard in db.shards():
+            with shard.connection() as conn:
+                checkpoints[shard.name] = last_checkpoint(conn)
+        print(json.dumps({"checkpoints": checkpoints}))
+    else:
+        try:
+            print(json.dumps({"updated": rebuild(args.user_ids or None)}))
+        except OpeningPending as e:
+            raise SystemExit(str(e))
+
+
+if __name__ == '__main__':
+    main()
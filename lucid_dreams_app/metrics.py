@@ -0,0 +1,310 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+from time import perf_counter
+
+# Метрики запросов: время по маршрутам и фазам, число и время SQL-выражений.
+# Каждый воркер копит свои значения; если задан METRICS_DIR, воркеры сбрасывают их туда
+# раз в METRICS_FLUSH_INTERVAL секунд, и /metrics любого воркера показывает сумму по всем.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+# Описания фоновых гистограмм для # HELP
+HISTOGRAM_HELP = {
+    "sqlite_write_batch_seconds": "Duration of a group-commit write batch.",
+    "sqlite_write_commit_seconds": "Duration of COMMIT of a write batch.",
+    "telegram_send_seconds": "Duration of a Telegram API send from the outbox.",
+}
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+# Таймер одного запроса; фазы накапливаются, если встречаются несколько раз
+class RequestTimer:
+    __slots__ = ('route', 'method', 'started', 'phases', 'sql_count', 'sql_seconds', 'elapsed')
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.started = perf_counter()
+        self.phases = {}
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.elapsed = 0.0
+
+
+class _RouteStats:
+    __slots__ = ('histogram', 'statuses', 'phases', 'sql_count', 'sql_seconds')
+
+    def __init__(self):
+        self.histogram = Histogram()
+        self.statuses = {}
+        self.phases = {}
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+
+
+_current = contextvars.ContextVar('request_timer', default=None)
+_lock = threading.Lock()
+_routes = {}
+# Фоновые операции без запроса: пачки записи, отправка в Telegram и т.п.
+_histograms = {}
+_background_sql = [0, 0.0]
+
+
+def begin(route, method):
+    if not METRICS_ENABLED:
+        return None
+    timer = RequestTimer(route, method)
+    _current.set(timer)
+    return timer
+
+
+# Завершает текущий запрос и учитывает его в метриках; возвращает таймер или None, если запроса нет
+def end(status):
+    timer = _current.get()
+    if timer is None:
+        return None
+    _current.set(None)
+    timer.elapsed = perf_counter() - timer.started
+    key = (timer.route, timer.method)
+    with _lock:
+        stats = _routes.get(key)
+        if stats is None:
+            stats = _routes[key] = _RouteStats()
+        stats.histogram.observe(timer.elapsed)
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        for name, seconds in timer.phases.items():
+            stats.phases[name] = stats.phases.get(name, 0.0) + seconds
+        stats.sql_count += timer.sql_count
+        stats.sql_seconds += timer.sql_seconds
+    return timer
+
+
+def current():
+    return _current.get()
+
+
+class phase:
+    __slots__ = ('name', 'timer', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timer = _current.get()
+        if self.timer is not None:
+            self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        timer = self.timer
+        if timer is not None:
+            timer.phases[self.name] = timer.phases.get(self.name, 0.0) + perf_counter() - self.started
+
+
+# Время фоновой операции в гистограмму name
+class timed:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, perf_counter() - self.started)
+
+
+# Вызывается соединением SQLite после каждого выражения
+def record_sql(seconds):
+    timer = _current.get()
+    if timer is not None:
+        timer.sql_count += 1
+        timer.sql_seconds += seconds
+    else:
+        with _lock:
+            _background_sql[0] += 1
+            _background_sql[1] += seconds
+
+
+def observe(name, seconds):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+
+# Заголовок Server-Timing: общее время, фазы и SQL
+def server_timing(timer):
+    parts = [f'app;dur={timer.elapsed * 1000:.3f}']
+    for name, seconds in timer.phases.items():
+        parts.append(f'{name};dur={seconds * 1000:.3f}')
+    if timer.sql_count:
+        parts.append(f'sql;dur={timer.sql_seconds * 1000:.3f};desc="{timer.sql_count} statements"')
+    return ', '.join(parts)
+
+
+def _histogram_data(histogram):
+    return {"counts": list(histogram.counts), "sum": histogram.sum, "count": histogram.count}
+
+
+def snapshot():
+    with _lock:
+        return {
+            "routes": [
+                {"route": route, "method": method, "histogram": _histogram_data(stats.histogram),
+                 "statuses": {str(status): n for status, n in stats.statuses.items()},
+                 "phases": dict(stats.phases), "sql_count": stats.sql_count, "sql_seconds": stats.sql_seconds}
+                for (route, method), stats in _routes.items()
+            ],
+            "histograms": {name: _histogram_data(histogram) for name, histogram in _histograms.items()},
+            "background_sql": list(_background_sql),
+        }
+
+
+def _merge_histogram(into, data):
+    if into is None:
+        return {"counts": list(data["counts"]), "sum": data["sum"], "count": data["count"]}
+    into["counts"] = [a + b for a, b in zip(into["counts"], data["counts"])]
+    into["sum"] += data["sum"]
+    into["count"] += data["count"]
+    return into
+
+
+def merge(snapshots):
+    routes = {}
+    histograms = {}
+    background = [0, 0.0]
+    for data in snapshots:
+        for entry in data["routes"]:
+            key = (entry["route"], entry["method"])
+            merged = routes.get(key)
+            if merged is None:
+                merged = routes[key] = {"histogram": None, "statuses": {}, "phases": {}, "sql_count": 0, "sql_seconds": 0.0}
+            merged["histogram"] = _merge_histogram(merged["histogram"], entry["histogram"])
+            for status, n in entry["statuses"].items():
+                merged["statuses"][status] = merged["statuses"].get(status, 0) + n
+            for name, seconds in entry["phases"].items():
+                merged["phases"][name] = merged["phases"].get(name, 0.0) + seconds
+            merged["sql_count"] += entry["sql_count"]
+            merged["sql_seconds"] += entry["sql_seconds"]
+        for name, data_histogram in data["histograms"].items():
+            histograms[name] = _merge_histogram(histograms.get(name), data_histogram)
+        background[0] += data["background_sql"][0]
+        background[1] += data["background_sql"][1]
+    return routes, histograms, background
+
+
+def _path(pid):
+    return os.path.join(METRICS_DIR, f'metrics-{pid}.json')
+
+
+def flush():
+    path = _path(os.getpid())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+
+# Свои метрики берутся из памяти, метрики других воркеров - из их последних файлов
+def collect():
+    snapshots = [snapshot()]
+    if METRICS_DIR:
+        own = _path(os.getpid())
+        for name in os.listdir(METRICS_DIR):
+            path = os.path.join(METRICS_DIR, name)
+            if name.startswith('metrics-') and name.endswith('.json') and path != own:
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+    return merge(snapshots)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _histogram_lines(name, labels, histogram):
+    lines = []
+    cumulative = 0
+    for bound, n in zip(BUCKETS + ('+Inf',), histogram["counts"]):
+        cumulative += n
+        lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+    labels = f'{{{labels.rstrip(",")}}}' if labels else ''
+    lines.append(f'{name}_sum{labels} {histogram["sum"]:.6f}')
+    lines.append(f'{name}_count{labels} {histogram["count"]}')
+    return lines
+
+
+# Текстовый формат Prometheus
+def render():
+    routes, histograms, background = collect()
+    lines = [
+        '# HELP http_request_duration_seconds Request duration by route.',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    for (route, method), entry in sorted(routes.items()):
+        lines += _histogram_lines('http_request_duration_seconds', f'route="{_label(route)}",method="{method}",', entry["histogram"])
+    lines += ['# HELP http_requests_total Requests by route and status.', '# TYPE http_requests_total counter']
+    for (route, method), entry in sorted(routes.items()):
+        for status, n in sorted(entry["statuses"].items()):
+            lines.append(f'http_requests_total{{route="{_label(route)}",method="{method}",status="{status}"}} {n}')
+    lines += ['# HELP http_request_phase_seconds_total Time spent in each request phase.',
+              '# TYPE http_request_phase_seconds_total counter']
+    for (route, method), entry in sorted(routes.items()):
+        for name, seconds in sorted(entry["phases"].items()):
+            lines.append(f'http_request_phase_seconds_total{{route="{_label(route)}",method="{method}",phase="{name}"}} {seconds:.6f}')
+    # Строки одной метрики в формате Prometheus должны идти подряд, под своими HELP и TYPE
+    lines += ['# HELP sqlite_statements_total SQL statements executed.', '# TYPE sqlite_statements_total counter']
+    for (route, method), entry in sorted(routes.items()):
+        lines.append(f'sqlite_statements_total{{route="{_label(route)}",method="{method}"}} {entry["sql_count"]}')
+    lines.append(f'sqlite_statements_total{{route="background",method=""}} {background[0]}')
+    lines += ['# HELP sqlite_statement_seconds_total Time spent executing SQL statements.',
+              '# TYPE sqlite_statement_seconds_total counter']
+    for (route, method), entry in sorted(routes.items()):
+        lines.append(f'sqlite_statement_seconds_total{{route="{_label(route)}",method="{method}"}} {entry["sql_seconds"]:.6f}')
+    lines.append(f'sqlite_statement_seconds_total{{route="background",method=""}} {background[1]:.6f}')
+    for name, histogram in sorted(histograms.items()):
+        lines += [f'# HELP {name} {HISTOGRAM_HELP.get(name, name.replace("_", " ").capitalize() + ".")}',
+                  f'# TYPE {name} histogram']
+        lines += _histogram_lines(name, '', histogram)
+    return '\n'.join(lines) + '\n'
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+def start():
+    if METRICS_ENABLED and METRICS_DIR:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
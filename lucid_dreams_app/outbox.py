@@ -0,0 +1,208 @@
+import fcntl
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from telegram.error import BadRequest, RetryAfter, Unauthorized
+
+import metrics
+from db import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# Очередь исходящих сообщений Telegram в отдельном файле SQLite
+OUTBOX_DB = os.getenv("OUTBOX_DB", "outbox.db")
+OUTBOX_SENDERS = int(os.getenv("OUTBOX_SENDERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "1"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "300"))
+# Сообщение, взятое отправителем, возвращается в очередь, если он не отчитался за это время
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))
+# Ограничения Telegram: около 30 сообщений в секунду всего и 1 в секунду в один чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1"))
+
+pool = ConnectionPool(OUTBOX_DB)
+
+
+def init_outbox():
+    with pool.connection() as conn:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute('''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            update_id INTEGER UNIQUE,
+            chat_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL,
+            leased_until REAL NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            last_error TEXT
+        )''')
+        conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt)")
+        conn.commit()
+
+
+_wakeup = threading.Event()
+
+
+# Кладет ответ в очередь; повтор того же update_id от Telegram игнорируется
+def enqueue(chat_id, text, reply_markup=None, update_id=None):
+    payload = json.dumps({"text": text, "reply_markup": reply_markup}, ensure_ascii=False)
+    with pool.connection() as conn:
+        conn.execute("INSERT OR IGNORE INTO outbox (update_id, chat_id, payload, next_attempt) VALUES (?, ?, ?, ?)",
+                     (update_id, chat_id, payload, time.time()))
+        conn.commit()
+    _wakeup.set()
+
+
+# Атомарно берет одно готовое к отправке сообщение
+def claim(now=None):
+    now = time.time() if now is None else now
+    with pool.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute('''SELECT id, chat_id, payload, attempts FROM outbox
+                              WHERE status = 'pending' AND next_attempt <= ? AND leased_until <= ?
+                              ORDER BY next_attempt LIMIT 1''', (now, now)).fetchone()
+        if row:
+            conn.execute("UPDATE outbox SET leased_until = ? WHERE id = ?", (now + OUTBOX_LEASE, row[0]))
+        conn.commit()
+    return row
+
+
+def _finish(sql, params):
+    with pool.connection() as conn:
+        conn.execute(sql, params)
+        conn.commit()
+
+
+def delivered(job_id):
+    _finish("DELETE FROM outbox WHERE id = ?", (job_id,))
+
+
+# Откладывает сообщение без учета попытки (например, из-за лимита на чат)
+def postpone(job_id, until):
+    _finish("UPDATE outbox SET next_attempt = ?, leased_until = 0 WHERE id = ?", (until, job_id))
+
+
+def failed(job_id, attempts, error, retry_after=None, permanent=False):
+    attempts += 1
+    if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+        _finish("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                (attempts, str(error), job_id))
+        return
+    if retry_after is None:
+        # Экспоненциальная задержка со случайным разбросом
+        retry_after = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX) * random.uniform(0.5, 1.5)
+    _finish("UPDATE outbox SET attempts = ?, next_attempt = ?, leased_until = 0, last_error = ? WHERE id = ?",
+            (attempts, time.time() + retry_after, str(error), job_id))
+
+
+class RateLimiter:
+    def __init__(self, rate=TELEGRAM_GLOBAL_RATE, chat_interval=TELEGRAM_CHAT_INTERVAL):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    # Время (time.time()), раньше которого в чат писать нельзя, или None, если можно сейчас
+    def chat_busy_until(self, chat_id):
+        now = time.time()
+        with self._lock:
+            allowed = self._chats.get(chat_id, 0)
+            if allowed > now:
+                return allowed
+            self._chats[chat_id] = now + self.chat_interval
+            if len(self._chats) > 10000:
+                self._chats = {c: t for c, t in self._chats.items() if t > now}
+            return None
+
+    # Ждет свободный токен общего лимита
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class Sender:
+    def __init__(self, bot, threads=OUTBOX_SENDERS):
+        self.bot = bot
+        self.threads = threads
+        self.limiter = RateLimiter()
+
+    def send(self, job):
+        job_id, chat_id, payload, attempts = job
+        busy_until = self.limiter.chat_busy_until(chat_id)
+        if busy_until is not None:
+            postpone(job_id, busy_until)
+            return
+        self.limiter.acquire()
+        message = json.loads(payload)
+        try:
+            with metrics.timed("telegram_send_seconds"):
+                self.bot.send_message(chat_id=chat_id, text=message["text"], reply_markup=message["reply_markup"])
+        except RetryAfter as e:
+            failed(job_id, attempts, e, retry_after=e.retry_after)
+        except (BadRequest, Unauthorized) as e:
+            failed(job_id, attempts, e, permanent=True)
+        except Exception as e:
+            logger.warning("Telegram send to %s failed: %s", chat_id, e)
+            failed(job_id, attempts, e)
+        else:
+            delivered(job_id)
+
+    def _run(self):
+        while True:
+            try:
+                job = claim()
+            except Exception:
+                logger.exception("outbox claim failed")
+                job = None
+            if job is None:
+                _wakeup.wait(0.5)
+                _wakeup.clear()
+                continue
+            try:
+                self.send(job)
+            except Exception:
+                logger.exception("outbox send failed")
+
+    def start(self):
+        for i in range(self.threads):
+            threading.Thread(target=self._run, name=f"outbox-sender-{i}", daemon=True).start()
+
+
+_leader_lock = None
+
+
+# Отправители работают только в одном воркере gunicorn, чтобы лимиты Telegram были общими;
+# блокировка снимается ОС при завершении процесса, и ее забирает другой воркер
+def _lead(bot, lock_path):
+    global _leader_lock
+    lock_file = open(lock_path, 'w')
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            time.sleep(5)
+            continue
+        _leader_lock = lock_file
+        Sender(bot).start()
+        return
+
+
+def start(bot):
+    lock_path = os.path.abspath(OUTBOX_DB) + '.lock'
+    threading.Thread(target=_lead, args=(bot, lock_path), name="outbox-leader", daemon=True).start()
@@ -0,0 +1,257 @@
+import json
+import logging
+import math
+import os
+import random
+import signal
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Сэмплирующий профайлер: отдельный поток раз в PROFILER_INTERVAL секунд снимает стеки потоков
+# через sys._current_frames и пишет их в PROFILER_DIR в формате collapsed stacks
+# (flamegraph.pl, speedscope, inferno). Пока он выключен, запрос платит только за проверку флага.
+#
+# Два режима:
+# - worker: весь процесс, только потоки, которые тратят CPU. Включается сигналом PROFILER_SIGNAL
+#   конкретному воркеру (kill -USR2 <pid>) или через /admin/profiler; повторный сигнал выключает.
+# - requests: PROFILER_SAMPLE_PERCENT процентов запросов к маршрутам PROFILER_ROUTES во всех воркерах,
+#   полное время запроса с ожиданием базы. Включается переменной окружения или через /admin/profiler.
+# В asgi.py собственные асинхронные маршруты делят поток event loop, поэтому там работает только режим worker.
+PROFILER_DIR = os.getenv("PROFILER_DIR", "profiles")
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL_MS", "5")) / 1000
+PROFILER_SAMPLE_PERCENT = float(os.getenv("PROFILER_SAMPLE_PERCENT", "0"))
+PROFILER_ROUTES = set(os.getenv("PROFILER_ROUTES", "webapp,buy_item,buy_diamonds,webhook").split(","))
+# Режим worker выключается сам через столько секунд, если его не выключили раньше
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+PROFILER_FLUSH_INTERVAL = float(os.getenv("PROFILER_FLUSH_INTERVAL", "10"))
+PROFILER_SIGNAL = os.getenv("PROFILER_SIGNAL", "SIGUSR2")
+# Секрет для /admin/profiler; без него управление только сигналом и переменными окружения
+PROFILER_SECRET = os.getenv("PROFILER_SECRET")
+# Режим requests для всех воркеров задается файлом в PROFILER_DIR, воркеры проверяют его раз в секунду
+CONTROL_FILE = 'control.json'
+CONTROL_CHECK_INTERVAL = 1.0
+MAX_DEPTH = 128
+
+
+def _frame_name(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def collapse(frame):
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+class Session:
+    def __init__(self, kind, seconds):
+        self.kind = kind
+        self.until = time.monotonic() + seconds
+        self.path = os.path.join(PROFILER_DIR, f'{kind}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.collapsed')
+        self.stacks = {}
+        self.samples = 0
+        self.next_flush = time.monotonic() + PROFILER_FLUSH_INTERVAL
+
+    def add(self, label, frame):
+        stack = f'{label};{collapse(frame)}'
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    # Файл переписывается целиком, поэтому промежуточные сбросы можно читать в любой момент
+    def write(self):
+        os.makedirs(PROFILER_DIR, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f'{stack} {count}\n')
+        os.replace(self.path + '.tmp', self.path)
+        self.next_flush = time.monotonic() + PROFILER_FLUSH_INTERVAL
+
+    def info(self):
+        left = self.until - time.monotonic()
+        return {"mode": self.kind, "file": self.path, "samples": self.samples,
+                "seconds_left": None if math.isinf(left) else max(0, round(left, 1))}
+
+
+_lock = threading.Lock()
+_thread = None
+_worker = None
+_requests = None
+_percent = 0.0
+# Потоки, которые сейчас обрабатывают выбранные запросы: ident -> маршрут
+_active = {}
+_control_path = os.path.join(PROFILER_DIR, CONTROL_FILE) if PROFILER_SECRET else None
+_control_mtime = None
+_next_check = 0.0
+
+
+# Время CPU потока; None, если поток уже завершился
+def _cpu_time(ident):
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (OSError, AttributeError):
+        return None
+
+
+def _sample_worker(session, frames, cpu, own):
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for ident, frame in frames.items():
+        if ident == own:
+            continue
+        used = _cpu_time(ident)
+        previous = cpu.get(ident)
+        cpu[ident] = used
+        # Потоки, которые ждут ввода-вывода или блокировок, не попадают в профиль
+        if used is None or previous is None or used <= previous:
+            continue
+        session.add(_active.get(ident) or names.get(ident, 'thread'), frame)
+
+
+def _finish(session):
+    try:
+        session.write()
+        logger.warning("profile written to %s (%d samples)", session.path, session.samples)
+    except OSError:
+        logger.exception("profile %s could not be written", session.path)
+
+
+def _run():
+    global _thread, _worker, _requests, _percent
+    own = threading.get_ident()
+    cpu = {}
+    while True:
+        time.sleep(PROFILER_INTERVAL)
+        now = time.monotonic()
+        with _lock:
+            if _worker is not None and now >= _worker.until:
+                _finish(_worker)
+                _worker = None
+            if _requests is not None and now >= _requests.until:
+                _percent = 0.0
+                _finish(_requests)
+                _requests = None
+            if _worker is None and _requests is None:
+                _thread = None
+                return
+            worker, requests = _worker, _requests
+        frames = sys._current_frames()
+        if worker is not None:
+            _sample_worker(worker, frames, cpu, own)
+        if requests is not None:
+            for ident, route in list(_active.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    requests.add(route, frame)
+            if now >= requests.next_flush:
+                _finish(requests)
+        del frames
+
+
+# Вызывается под _lock
+def _ensure_thread():
+    global _thread
+    if _thread is None:
+        _thread = threading.Thread(target=_run, name="profiler", daemon=True)
+        _thread.start()
+
+
+def start_worker(seconds=PROFILER_MAX_SECONDS):
+    global _worker
+    with _lock:
+        if _worker is None:
+            _worker = Session('worker', seconds)
+        _ensure_thread()
+        return _worker.info()
+
+
+# Сессия дописывается и закрывается потоком профайлера на следующем шаге
+def stop_worker():
+    with _lock:
+        if _worker is None:
+            return None
+        _worker.until = 0
+        return _worker.info()
+
+
+def start_requests(percent, seconds=math.inf):
+    global _requests, _percent
+    with _lock:
+        if percent <= 0:
+            if _requests is not None:
+                _requests.until = 0
+            _percent = 0.0
+            return None
+        if _requests is None:
+            _requests = Session('requests', seconds)
+        _requests.until = time.monotonic() + seconds
+        _percent = percent
+        _ensure_thread()
+        return _requests.info()
+
+
+def status():
+    with _lock:
+        return {"pid": os.getpid(), "percent": _percent,
+                "worker": _worker.info() if _worker is not None else None,
+                "requests": _requests.info() if _requests is not None else None}
+
+
+# Режим requests для всех воркеров: /admin/profiler записывает файл, каждый воркер его подхватывает
+def set_control(percent, seconds):
+    os.makedirs(PROFILER_DIR, exist_ok=True)
+    path = os.path.join(PROFILER_DIR, CONTROL_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({"percent": percent, "until": time.time() + seconds}, f)
+    os.replace(path + '.tmp', path)
+
+
+def _check_control():
+    global _control_mtime, _next_check
+    _next_check = time.monotonic() + CONTROL_CHECK_INTERVAL
+    try:
+        mtime = os.stat(_control_path).st_mtime_ns
+        if mtime == _control_mtime:
+            return
+        _control_mtime = mtime
+        with open(_control_path) as f:
+            control = json.load(f)
+    except (OSError, ValueError):
+        return
+    seconds = control["until"] - time.time()
+    start_requests(control["percent"] if seconds > 0 else 0, max(seconds, 0))
+
+
+# Начало и конец запроса; включенный профайлер запоминает поток, пока тот обрабатывает выбранный запрос
+def enter(route):
+    if _control_path is not None and time.monotonic() >= _next_check:
+        _check_control()
+    if _percent and route in PROFILER_ROUTES and random.random() * 100 < _percent:
+        _active[threading.get_ident()] = route
+
+
+def leave():
+    if _active:
+        _active.pop(threading.get_ident(), None)
+
+
+# В обработчике сигнала блокировки не берутся: включение уходит в отдельный поток
+def _toggle(signum, frame):
+    worker = _worker
+    if worker is None:
+        threading.Thread(target=start_worker, name="profiler-toggle", daemon=True).start()
+    else:
+        worker.until = 0
+
+
+# Обработчик сигнала ставится только из главного потока; с gunicorn --preload воркер сбрасывает
+# сигналы после fork, тогда профайлер включается через /admin/profiler
+def install():
+    if PROFILER_SAMPLE_PERCENT > 0:
+        start_requests(PROFILER_SAMPLE_PERCENT)
+    if PROFILER_SIGNAL and threading.current_thread() is threading.main_thread():
+        signal.signal(getattr(signal, PROFILER_SIGNAL), _toggle)
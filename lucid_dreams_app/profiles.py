@@ -0,0 +1,104 @@
+import energy
+from cache import profiles as cache
+from db import read, run_async, write, write_async
+
+# В кэше лежит энергия в том виде, в каком она хранится в базе; текущее значение считается при выдаче
+DEFAULT_PROFILE = {"diamonds": 0, "energy_at": energy.ENERGY_MAX, "energy_updated_ts": 0, "style": 'nika', "language": 'Русский'}
+
+PROFILE_SQL = "SELECT diamonds, energy_at, energy_updated_ts, style, language FROM users WHERE user_id = ?"
+PROFILE_WITH_PURCHASES_SQL = '''SELECT u.diamonds, u.energy_at, u.energy_updated_ts, u.style, u.language, i.item, i.count
+                                 FROM users u LEFT JOIN inventory i ON i.user_id = u.user_id
+                                 WHERE u.user_id = ?'''
+
+
+# Профиль пользователя (кристаллы, энергия, стиль, язык); новый пользователь создается при первом обращении
+def get_profile(user_id):
+    user_id = int(user_id)
+    profile = cache.get(user_id)
+    if profile is not None:
+        return present(profile)
+    generation = cache.generation(user_id)
+    user = read(lambda conn: conn.execute(PROFILE_SQL, (user_id,)).fetchone(), user_id)
+    profile = _row_to_profile(user) if user else _create(user_id)
+    cache.set(user_id, profile, generation)
+    return present(profile)
+
+
+def _row_to_profile(row):
+    return {"diamonds": row[0], "energy_at": row[1], "energy_updated_ts": row[2], "style": row[3], "language": row[4]}
+
+
+# Профиль для клиента: текущая энергия, ее максимум, секунды до следующей единицы и интервал восстановления
+def present(profile):
+    energy_at, updated_ts = profile["energy_at"], profile["energy_updated_ts"]
+    return {
+        "diamonds": profile["diamonds"],
+        "energy": energy.current(energy_at, updated_ts),
+        "energy_max": energy.ENERGY_MAX,
+        "energy_next": energy.seconds_to_next(energy_at, updated_ts),
+        "energy_regen": energy.ENERGY_REGEN_SECONDS,
+        "style": profile["style"],
+        "language": profile["language"],
+    }
+
+
+def _create(user_id):
+    write(lambda conn: conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,)), user_id)
+    return dict(DEFAULT_PROFILE)
+
+
+# Профиль и купленные предметы ({предмет: количество}) одним запросом к БД
+def get_profile_with_purchases(user_id):
+    user_id = int(user_id)
+    generation = cache.generation(user_id)
+    rows = read(lambda conn: conn.execute(PROFILE_WITH_PURCHASES_SQL, (user_id,)).fetchall(), user_id)
+    if not rows:
+        return present(_create(user_id)), {}
+    profile = _row_to_profile(rows[0])
+    cache.set(user_id, profile, generation)
+    return present(profile), {row[5]: row[6] for row in rows if row[5] is not None}
+
+
+async def get_profile_async(user_id):
+    profile = cache.get(int(user_id))
+    if profile is not None:
+        return present(profile)
+    return await run_async(get_profile, user_id)
+
+
+async def get_profile_with_purchases_async(user_id):
+    return await run_async(get_profile_with_purchases, user_id)
+
+
+def _update_job(user_id, column, value):
+    sql = f"UPDATE users SET {column} = ? WHERE user_id = ?"
+    return lambda conn: conn.execute(sql, (value, user_id))
+
+
+def set_style(user_id, style):
+    user_id = int(user_id)
+    write(_update_job(user_id, 'style', style), user_id)
+    cache.update(user_id, style=style)
+
+
+def set_language(user_id, language):
+    user_id = int(user_id)
+    write(_update_job(user_id, 'language', language), user_id)
+    cache.update(user_id, language=language)
+
+
+async def set_style_async(user_id, style):
+    user_id = int(user_id)
+    await write_async(_update_job(user_id, 'style', style), user_id)
+    cache.update(user_id, style=style)
+
+
+async def set_language_async(user_id, language):
+    user_id = int(user_id)
+    await write_async(_update_job(user_id, 'language', language), user_id)
+    cache.update(user_id, language=language)
+
+
+# Запись нового баланса в кэш после покупки или пополнения
+def set_diamonds(user_id, diamonds):
+    cache.update(int(user_id), diamonds=diamonds)
@@ -0,0 +1,175 @@
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Журнал медленных запросов: выражения дольше SQL_SLOW_MS логируются вместе с EXPLAIN QUERY PLAN
+# и суммируются по нормализованному тексту (литералы и списки IN заменены на ?).
+# Время - это execute(), для SELECT первый шаг выборки; обычно в нем и весь поиск.
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "50"))
+# SQL_SLOW_MS=0 выключает журнал
+SQL_SLOW_SECONDS = SQL_SLOW_MS / 1000 if SQL_SLOW_MS > 0 else math.inf
+# Проверка планов для тестов и нагрузочных прогонов: каждое новое выражение внутри запроса
+# разбирается через EXPLAIN QUERY PLAN, полный просмотр таблицы больше SQL_SCAN_ROWS строк -
+# предупреждение (warn) или исключение FullScan (error). В продакшене выключена.
+# Запрос от фоновой работы отличается по таймеру metrics, поэтому проверка требует METRICS_ENABLED=1.
+SQL_SCAN_CHECK = os.getenv("SQL_SCAN_CHECK", "off")
+SQL_SCAN_ROWS = int(os.getenv("SQL_SCAN_ROWS", "10000"))
+# Таблицы растут во время прогона: оценка числа строк и проверенный план устаревают через столько секунд
+SQL_SCAN_RECHECK = float(os.getenv("SQL_SCAN_RECHECK", "10"))
+# Сколько разных выражений хранить в сводке
+SQL_STATS_LIMIT = 500
+
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_LISTS = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+_SPACES = re.compile(r'\s+')
+# Полный просмотр без индекса; в SQLite до 3.36 план пишется как SCAN TABLE users
+_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+
+class FullScan(Exception):
+    pass
+
+
+def normalize(sql):
+    sql = _STRINGS.sub('?', sql)
+    sql = _NUMBERS.sub('?', sql)
+    sql = _LISTS.sub('IN (...)', sql)
+    return _SPACES.sub(' ', sql).strip()
+
+
+class StatementStats:
+    __slots__ = ('count', 'seconds', 'max_seconds', 'plan')
+
+    def __init__(self, plan):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.plan = plan
+
+
+_lock = threading.Lock()
+_slow = {}
+# (файл базы, нормализованное выражение) -> (план, когда проверен); заполняется только при проверке планов
+_checked = {}
+# (файл базы, таблица) -> (оценка числа строк, когда посчитана); у шардов размеры таблиц разные
+_table_rows = {}
+_scan_warnings = {}
+
+if SQL_SCAN_CHECK != 'off' and not metrics.METRICS_ENABLED:
+    logger.warning("SQL_SCAN_CHECK=%s is ignored: it needs METRICS_ENABLED=1", SQL_SCAN_CHECK)
+
+
+def explain(conn, sql, parameters=()):
+    if not sql.lstrip()[:7].upper().startswith(EXPLAINABLE):
+        return None
+    try:
+        rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error:
+        return None
+    return [row[3] for row in rows]
+
+
+# Оценка числа строк по max(rowid), без полного подсчета; для WITHOUT ROWID - count(*)
+def table_rows(conn, table):
+    key = (getattr(conn, 'path', None), table)
+    rows, counted = _table_rows.get(key, (None, 0.0))
+    if rows is None or time.monotonic() - counted >= SQL_SCAN_RECHECK:
+        try:
+            rows = sqlite3.Connection.execute(conn, f'SELECT max(rowid) FROM "{table}"').fetchone()[0] or 0
+        except sqlite3.Error:
+            try:
+                rows = sqlite3.Connection.execute(conn, f'SELECT count(*) FROM "{table}"').fetchone()[0]
+            except sqlite3.Error:
+                rows = 0
+        _table_rows[key] = (rows, time.monotonic())
+    return rows
+
+
+def _check_plan(conn, sql, parameters, key):
+    database = getattr(conn, 'path', None)
+    plan = explain(conn, sql, parameters)
+    with _lock:
+        if (database, key) in _checked or len(_checked) < SQL_STATS_LIMIT:
+            _checked[(database, key)] = (plan, time.monotonic())
+    for detail in plan or ():
+        match = _SCAN.match(detail)
+        if match is None:
+            continue
+        table = match.group(1)
+        rows = table_rows(conn, table)
+        if rows < SQL_SCAN_ROWS:
+            continue
+        timer = metrics.current()
+        route = timer.route if timer is not None else None
+        with _lock:
+            _scan_warnings[key] = {"statement": key, "table": table, "rows": rows, "route": route, "plan": plan,
+                                   "database": database}
+        logger.warning("full scan of %s (~%d rows) in %s: %s", table, rows, route, key)
+        if SQL_SCAN_CHECK == 'error':
+            raise FullScan(f"full scan of {table} (~{rows} rows): {key}")
+
+
+def _needs_check(conn, key):
+    checked = _checked.get((getattr(conn, 'path', None), key))
+    if checked is None:
+        return len(_checked) < SQL_STATS_LIMIT
+    return time.monotonic() - checked[1] >= SQL_SCAN_RECHECK
+
+
+# Вызывается соединением после выражения, которое было медленным или еще не проверялось
+def observe(conn, sql, parameters, seconds):
+    key = None
+    if SQL_SCAN_CHECK != 'off' and parameters is not None and metrics.current() is not None:
+        key = normalize(sql)
+        if _needs_check(conn, key):
+            _check_plan(conn, sql, parameters, key)
+    if seconds < SQL_SLOW_SECONDS:
+        return
+    key = key or normalize(sql)
+    stats = _slow.get(key)
+    if stats is None:
+        checked = _checked.get((getattr(conn, 'path', None), key))
+        plan = checked[0] if checked else (explain(conn, sql, parameters) if parameters is not None else None)
+        with _lock:
+            if len(_slow) < SQL_STATS_LIMIT:
+                stats = _slow.setdefault(key, StatementStats(plan))
+    else:
+        plan = stats.plan
+    if stats is not None:
+        with _lock:
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+    logger.warning("slow query %.1f ms: %s | plan: %s", seconds * 1000, key, '; '.join(plan or ()) or '-')
+
+
+# Сброс сводки и кэшей проверки между прогонами (например, между тестами)
+def reset():
+    with _lock:
+        _slow.clear()
+        _checked.clear()
+        _table_rows.clear()
+        _scan_warnings.clear()
+
+
+# Сводка для /slow_queries: самые затратные выражения первыми
+def report():
+    with _lock:
+        slow = [
+            {"statement": key, "count": stats.count, "total_ms": round(stats.seconds * 1000, 3),
+             "max_ms": round(stats.max_seconds * 1000, 3), "plan": stats.plan}
+            for key, stats in _slow.items()
+        ]
+        scans = list(_scan_warnings.values())
+    slow.sort(key=lambda entry: entry["total_ms"], reverse=True)
+    return {"pid": os.getpid(), "threshold_ms": SQL_SLOW_MS, "slow": slow, "full_scans": scans}
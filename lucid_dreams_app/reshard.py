@@ -0,0 +1,193 @@
+import argparse
+import fcntl
+import json
+import logging
+import os
+import time
+
+import db
+import schema
+import sharding
+
+logger = logging.getLogger(__name__)
+
+# Онлайн-решардинг: python reshard.py apply users-0.db users-1.db users-2.db
+# 1. Новые шарды получают схему; в раскладку (DB_SHARD_MAP) записывается целевое кольцо.
+# 2. После паузы RESHARD_GRACE, за которую все воркеры перечитывают раскладку, пользователи,
+#    чей шард в целевом кольце другой, переносятся порциями по RESHARD_BATCH. Порция копируется
+#    на новый шард и удаляется со старого, пока на старом шарде удерживается блокировка записи.
+# 3. Целевое кольцо становится текущим.
+# Приложение работает все это время: пока пользователь на старом шарде, его запросы идут туда,
+# после переноса db.route отправляет их на новый (см. db.write и db.read).
+# Прерванный решардинг продолжается повторным запуском с тем же списком шардов.
+RESHARD_BATCH = int(os.getenv("RESHARD_BATCH", "500"))
+RESHARD_GRACE = float(os.getenv("RESHARD_GRACE", str(max(5.0, 3 * sharding.SHARD_MAP_CHECK))))
+RESHARD_PAUSE = float(os.getenv("RESHARD_PAUSE", "0.01"))
+
+# Таблицы, строки которых принадлежат пользователю и переезжают вместе с ним
+USER_TABLES = ('users', 'purchases', 'inventory', 'ledger', 'balance_snapshots', 'idempotency')
+
+
+def _marks(values):
+    return ', '.join('?' * len(values))
+
+
+def _copy(src, dst, table, marks, user_ids):
+    cursor = src.execute(f"SELECT * FROM {table} WHERE user_id IN ({marks})", user_ids)
+    columns = [column[0] for column in cursor.description]
+    rows = cursor.fetchall()
+    if rows:
+        dst.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({_marks(columns)})", rows)
+
+
+# id покупок и записей журнала на новом шарде свои; ссылки журнала на покупки пересчитываются.
+# Снимок баланса не переносится: все записи журнала пользователя попадают на новом шарде
+# после его контрольной точки, и следующая точка соберет снимок заново.
+def _copy_history(src, dst, marks, user_ids):
+    purchases = {}
+    rows = src.execute(f"SELECT id, user_id, item, price, created_at FROM purchases WHERE user_id IN ({marks}) ORDER BY id",
+                       user_ids).fetchall()
+    for purchase_id, user_id, item, price, created_at in rows:
+        purchases[purchase_id] = dst.execute("INSERT INTO purchases (user_id, item, price, created_at) VALUES (?, ?, ?, ?)",
+                                             (user_id, item, price, created_at)).lastrowid
+    rows = src.execute(f"SELECT user_id, delta, reason, ref, created_at FROM ledger WHERE user_id IN ({marks}) ORDER BY id",
+                       user_ids).fetchall()
+    dst.executemany("INSERT INTO ledger (user_id, delta, reason, ref, created_at) VALUES (?, ?, ?, ?, ?)",
+                    [(user_id, delta, reason, purchases.get(ref, ref) if reason == 'buy_item' else ref, created_at)
+                     for user_id, delta, reason, ref, created_at in rows])
+
+
+# Переносит пользователей с source на dest; возвращает число перенесенных.
+# Сначала фиксируется копия на dest, затем удаление на source: при сбое между ними пользователь
+# остается на source, а повторный перенос сначала стирает неполную копию на dest.
+def move_users(source, dest, user_ids):
+    with source.connection() as src, dest.connection() as dst:
+        src.execute("BEGIN IMMEDIATE")
+        try:
+            present = [row[0] for row in src.execute(f"SELECT user_id FROM users WHERE user_id IN ({_marks(user_ids)})", user_ids)]
+            if not present:
+                src.rollback()
+                return 0
+            marks = _marks(present)
+            dst.execute("BEGIN IMMEDIATE")
+            try:
+                for table in USER_TABLES:
+                    dst.execute(f"DELETE FROM {table} WHERE user_id IN ({marks})", present)
+                for table in ('users', 'inventory', 'idempotency'):
+                    _copy(src, dst, table, marks, present)
+                _copy_history(src, dst, marks, present)
+            except BaseException:
+                dst.rollback()
+                raise
+            dst.commit()
+            for table in USER_TABLES:
+                src.execute(f"DELETE FROM {table} WHERE user_id IN ({marks})", present)
+        except BaseException:
+            src.rollback()
+            raise
+        src.commit()
+    return len(present)
+
+
+def _user_ids(shard, after, batch):
+    with shard.connection() as conn:
+        return [row[0] for row in conn.execute("SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after, batch))]
+
+
+# Один проход по пользователям шарда: переносит тех, кому по целевому кольцу место на другом шарде
+def drain(source, target, paths, batch=RESHARD_BATCH, pause=RESHARD_PAUSE):
+    moved = {}
+    after = -2 ** 63
+    while True:
+        user_ids = _user_ids(source, after, batch)
+        if not user_ids:
+            return moved
+        after = user_ids[-1]
+        leaving = {}
+        for user_id in user_ids:
+            owner = target.owner(user_id)
+            if owner != source.name:
+                leaving.setdefault(owner, []).append(user_id)
+        for name, ids in leaving.items():
+            moved[name] = moved.get(name, 0) + move_users(source, db.shard_at(name, paths[name]), ids)
+        if pause and leaving:
+            time.sleep(pause)
+
+
+def _lock():
+    lock_file = open(os.path.abspath(sharding.DB_SHARD_MAP) + '.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        raise SystemExit("another reshard.py is running")
+    return lock_file
+
+
+def apply(paths, batch=RESHARD_BATCH, grace=RESHARD_GRACE):
+    lock_file = _lock()
+    try:
+        current = sharding.load()
+        wanted = {sharding.shard_name(path): path for path in paths}
+        if len(wanted) != len(paths):
+            raise SystemExit("shard names (file names without extension) must be unique")
+        for name, path in wanted.items():
+            if name in current.paths and os.path.abspath(current.paths[name]) != os.path.abspath(path):
+                raise SystemExit(f"shard {name} is at {current.paths[name]}, not {path}")
+        if current.target is not None and current.target.names != sorted(wanted):
+            raise SystemExit(f"resharding to {current.target.names} is not finished; run it again with those shards")
+        paths = dict(current.paths, **wanted)
+        for name, path in wanted.items():
+            if name not in current.paths:
+                schema.migrate_shard(db.shard_at(name, path))
+        for name, path in paths.items():
+            if schema.pending_backfills(db.shard_at(name, path)):
+                raise SystemExit(f"shard {name} has unfinished backfills; let them finish first")
+
+        started = time.monotonic()
+        if current.target is None:
+            current = sharding.ShardMap(paths, current.ring.names, sorted(wanted), current.version)
+            sharding.save(current)
+            logger.warning("target ring published, waiting %.0fs for workers to pick it up", grace)
+            time.sleep(grace)
+        sharding.reload()
+        moved = {}
+        # Второй проход подбирает пользователей, созданных на старом шарде до того, как воркер увидел целевое кольцо
+        for _ in range(2):
+            for name in current.ring.names:
+                for dest, count in drain(db.shard_at(name, paths[name]), current.target, paths, batch).items():
+                    moved[f'{name}->{dest}'] = moved.get(f'{name}->{dest}', 0) + count
+        sharding.save(sharding.ShardMap(wanted, sorted(wanted), None, current.version))
+        sharding.reload()
+        return {"shards": sorted(wanted), "moved": moved, "seconds": round(time.monotonic() - started, 1)}
+    finally:
+        lock_file.close()
+
+
+def status():
+    shard_map = sharding.load()
+    report = dict(shard_map.to_json(), users={}, unowned_idempotency_keys={})
+    for shard in db.shards():
+        with shard.connection() as conn:
+            report["users"][shard.name] = conn.execute("SELECT count(*) FROM users").fetchone()[0]
+            report["unowned_idempotency_keys"][shard.name] = conn.execute(
+                "SELECT count(*) FROM idempotency WHERE user_id IS NULL").fetchone()[0]
+    return report
+
+
+# python reshard.py status | apply PATH [PATH ...]
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['status', 'apply'])
+    parser.add_argument('paths', nargs='*')
+    args = parser.parse_args()
+    if args.command == 'apply':
+        if not args.paths:
+            parser.error("apply needs the full list of shard files")
+        print(json.dumps(apply(args.paths), indent=2))
+    else:
+        print(json.dumps(status(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from db import set_journal_mode, shards
+
+logger = logging.getLogger(__name__)
+
+# Обратное заполнение больших таблиц идет небольшими порциями, каждая в своей транзакции
+BACKFILL_BATCH = int(os.getenv("BACKFILL_BATCH", "5000"))
+BACKFILL_PAUSE = float(os.getenv("BACKFILL_PAUSE", "0.01"))
+
+# Версионные миграции: номер версии -> функция, меняющая схему. Номер хранится в PRAGMA user_version.
+MIGRATIONS = {}
+# Заполнения: имя -> функция (conn, позиция, размер порции) -> новая позиция или None, если закончено
+BACKFILLS = {}
+
+
+def migration(version):
+    def register(fn):
+        MIGRATIONS[version] = fn
+        return fn
+    return register
+
+
+def backfill(name):
+    def register(fn):
+        BACKFILLS[name] = fn
+        return fn
+    return register
+
+
+# Ставит заполнение в очередь; вызывается из миграции в ее транзакции
+def schedule_backfill(conn, name, position=0):
+    conn.execute("INSERT OR IGNORE INTO backfills (name, position, done) VALUES (?, ?, 0)", (name, position))
+
+
+def _table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+@migration(1)
+def create_users(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        diamonds INTEGER DEFAULT 0,
+        energy INTEGER DEFAULT 100,
+        style TEXT DEFAULT 'nika',
+        language TEXT DEFAULT 'Русский'
+    )''')
+
+
+# Старая таблица purchases(user_id, item) без ключа и индексов переименовывается,
+# а ее строки переносятся в новую схему в фоне. Цена и время старых покупок неизвестны и остаются NULL.
+@migration(2)
+def create_purchases(conn):
+    if _table_exists(conn, 'purchases') and 'id' not in _columns(conn, 'purchases'):
+        conn.execute("ALTER TABLE purchases RENAME TO purchases_legacy")
+        schedule_backfill(conn, 'purchases_legacy')
+    conn.execute('''CREATE TABLE IF NOT EXISTS purchases (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        item TEXT NOT NULL,
+        price INTEGER,
+        created_at INTEGER,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS purchases_user_item ON purchases (user_id, item)")
+    conn.execute("CREATE INDEX IF NOT EXISTS purchases_created_at ON purchases (created_at)")
+    # Сводка владения: сколько раз пользователь купил предмет
+    conn.execute('''CREATE TABLE IF NOT EXISTS inventory (
+        user_id INTEGER NOT NULL,
+        item TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, item)
+    ) WITHOUT ROWID''')
+
+
+# Энергия хранится как значение на момент последнего изменения и время этого изменения;
+# текущее значение считается при чтении (energy.current), поэтому восстановление не пишет в базу.
+# Нулевое время у существующих строк означает полную энергию.
+@migration(3)
+def lazy_energy(conn):
+    conn.execute("ALTER TABLE users RENAME COLUMN energy TO energy_at")
+    conn.execute("ALTER TABLE users ADD COLUMN energy_updated_ts INTEGER NOT NULL DEFAULT 0")
+
+
+@backfill('purchases_legacy')
+def move_legacy_purchases(conn, position, batch):
+    top = conn.execute("SELECT max(rowid) FROM purchases_legacy").fetchone()[0]
+    if top is None or position >= top:
+        conn.execute("DROP TABLE purchases_legacy")
+        return None
+    # Порция - диапазон rowid: старая таблица только дополнялась, rowid идут почти подряд
+    upper = position + batch
+    conn.execute("INSERT INTO purchases (user_id, item) SELECT user_id, item FROM purchases_legacy WHERE rowid > ? AND rowid <= ? ORDER BY rowid",
+                 (position, upper))
+    conn.execute('''INSERT INTO inventory (user_id, item, count)
+                    SELECT user_id, item, COUNT(*) FROM purchases_legacy WHERE rowid > ? AND rowid <= ? GROUP BY user_id, item
+                    ON CONFLICT(user_id, item) DO UPDATE SET count = count + excluded.count''', (position, upper))
+    return upper
+
+
+# Журнал операций с кристаллами: только добавление строк. users.diamonds остается текущим балансом
+# и меняется в той же транзакции, что и запись журнала; balance_snapshots хранит балансы
+# на момент последней контрольной точки (ledger_checkpoints).
+@migration(4)
+def create_ledger(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS ledger (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        ref INTEGER,
+        created_at INTEGER NOT NULL
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS ledger_user ON ledger (user_id, id)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS balance_snapshots (
+        user_id INTEGER PRIMARY KEY,
+        diamonds INTEGER NOT NULL
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+        ledger_id INTEGER PRIMARY KEY,
+        created_at INTEGER NOT NULL
+    )''')
+    if conn.execute("SELECT 1 FROM users WHERE diamonds != 0 LIMIT 1").fetchone():
+        schedule_backfill(conn, 'ledger_opening', position=-1)
+
+
+# Начальные записи для балансов, появившихся до журнала. Операции, уже попавшие в журнал,
+# вычитаются, поэтому заполнение не мешает покупкам, идущим параллельно.
+@backfill('ledger_opening')
+def open_ledger(conn, position, batch):
+    rows = conn.execute('''SELECT user_id, coalesce(diamonds, 0) - coalesce((SELECT SUM(delta) FROM ledger l WHERE l.user_id = u.user_id), 0)
+                           FROM users u WHERE user_id > ? ORDER BY user_id LIMIT ?''', (position, batch)).fetchall()
+    if not rows:
+        return None
+    now = int(time.time())
+    conn.executemany("INSERT INTO ledger (user_id, delta, reason, created_at) VALUES (?, ?, 'opening', ?)",
+                     [(user_id, delta, now) for user_id, delta in rows if delta])
+    return rows[-1][0]
+
+
+# Ключи идемпотентности покупок: хэш ключа клиента (16 байт), параметры запроса и сохраненный результат
+@migration(5)
+def create_idempotency(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS idempotency (
+        key BLOB PRIMARY KEY,
+        request TEXT NOT NULL,
+        result INTEGER,
+        created_at INTEGER NOT NULL
+    ) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idempotency_created_at ON idempotency (created_at)")
+
+
+# Владелец ключа идемпотентности: по нему reshard.py переносит ключи вместе с пользователем.
+# У ключей, сохраненных до этой версии, владельца нет, они просто истекают через IDEMPOTENCY_TTL.
+@migration(6)
+def idempotency_owner(conn):
+    conn.execute("ALTER TABLE idempotency ADD COLUMN user_id INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idempotency_user ON idempotency (user_id)")
+
+
+# reshard.py удаляет записи журнала переехавших пользователей. Без AUTOINCREMENT SQLite выдал бы
+# освободившиеся id заново, и новые записи оказались бы ниже контрольной точки, мимо снимков.
+# Таблица пересоздается с AUTOINCREMENT; счетчик ставится не ниже последней контрольной точки.
+@migration(7)
+def ledger_autoincrement(conn):
+    conn.execute('''CREATE TABLE ledger_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        ref INTEGER,
+        created_at INTEGER NOT NULL
+    )''')
+    conn.execute("INSERT INTO ledger_new (id, user_id, delta, reason, ref, created_at) SELECT id, user_id, delta, reason, ref, created_at FROM ledger")
+    conn.execute("DROP TABLE ledger")
+    conn.execute("ALTER TABLE ledger_new RENAME TO ledger")
+    conn.execute("CREATE INDEX IF NOT EXISTS ledger_user ON ledger (user_id, id)")
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = 'ledger'")
+    conn.execute('''INSERT INTO sqlite_sequence (name, seq) SELECT 'ledger', max(
+                        coalesce((SELECT max(id) FROM ledger), 0),
+                        coalesce((SELECT max(ledger_id) FROM ledger_checkpoints), 0))''')
+
+
+def _lock(shard, name, blocking=True):
+    lock_file = open(f'{os.path.abspath(shard.path)}.{name}.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+# Применяет недостающие миграции к одному шарду. Блокировка на файле гарантирует, что схему меняет
+# один воркер, остальные дожидаются его и видят уже новую версию.
+def migrate_shard(shard):
+    lock_file = _lock(shard, 'migrate')
+    try:
+        with shard.connection() as conn:
+            set_journal_mode(conn)
+            conn.execute('''CREATE TABLE IF NOT EXISTS backfills (
+                name TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                done INTEGER NOT NULL
+            )''')
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            for version in sorted(v for v in MIGRATIONS if v > current):
+                started = time.monotonic()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    MIGRATIONS[version](conn)
+                    conn.execute(f"PRAGMA user_version = {version}")
+                except BaseException:
+                    conn.rollback()
+                    raise
+                conn.commit()
+                logger.info("schema of %s migrated to version %s in %.3fs", shard.name, version, time.monotonic() - started)
+    finally:
+        lock_file.close()
+
+
+def migrate():
+    for shard in shards():
+        migrate_shard(shard)
+
+
+def pending_backfills(shard):
+    with shard.connection() as conn:
+        return conn.execute("SELECT name, position FROM backfills WHERE done = 0 ORDER BY name").fetchall()
+
+
+# Одна порция заполнения в пишущей транзакции; возвращает True, если заполнение закончено
+def backfill_step(shard, name, position, batch=BACKFILL_BATCH):
+    def job(conn):
+        new_position = BACKFILLS[name](conn, position, batch)
+        if new_position is None:
+            conn.execute("UPDATE backfills SET done = 1 WHERE name = ?", (name,))
+        else:
+            conn.execute("UPDATE backfills SET position = ? WHERE name = ?", (new_position, name))
+        return new_position
+    return shard.write(job)
+
+
+def run_shard_backfills(shard, batch=BACKFILL_BATCH, pause=BACKFILL_PAUSE):
+    for name, position in pending_backfills(shard):
+        started = time.monotonic()
+        while position is not None:
+            position = backfill_step(shard, name, position, batch)
+            if pause:
+                time.sleep(pause)
+        logger.info("backfill %s on %s finished in %.1fs", name, shard.name, time.monotonic() - started)
+
+
+def run_backfills(batch=BACKFILL_BATCH, pause=BACKFILL_PAUSE):
+    for shard in shards():
+        run_shard_backfills(shard, batch, pause)
+
+
+def _run_backfills_locked(shard, lock_file):
+    try:
+        run_shard_backfills(shard)
+    except Exception:
+        logger.exception("backfill on %s failed, it will resume on the next start", shard.name)
+    finally:
+        lock_file.close()
+
+
+# Заполнения идут в фоне, по одному воркеру на шард; приложение в это время продолжает отвечать
+def start_backfills():
+    for shard in shards():
+        if not pending_backfills(shard):
+            continue
+        lock_file = _lock(shard, 'backfill', blocking=False)
+        if lock_file is None:
+            continue
+        threading.Thread(target=_run_backfills_locked, args=(shard, lock_file), name=f"schema-backfill-{shard.name}",
+                         daemon=True).start()
+
+
+# Инициализация базы данных SQLite
+def init_db():
+    migrate()
+    start_backfills()
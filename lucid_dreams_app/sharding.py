@@ -0,0 +1,107 @@
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Пользователи распределяются по файлам SQLite (шардам) консистентным хэшированием user_id.
+# DB_SHARDS - пути через запятую; имя шарда - имя файла без расширения, именно оно задает
+# точки на кольце, поэтому файл можно перенести в другой каталог без переезда пользователей.
+# Без DB_SHARDS единственный шард - DB_PATH, и все работает как с одной базой.
+# Если есть файл DB_SHARD_MAP (его пишет reshard.py), раскладка берется из него, а воркеры
+# перечитывают его на лету, проверяя время изменения не чаще раза в SHARD_MAP_CHECK секунд.
+DB_PATH = os.getenv("DB_PATH", "users.db")
+DB_SHARDS = [path.strip() for path in os.getenv("DB_SHARDS", "").split(",") if path.strip()] or [DB_PATH]
+DB_SHARD_MAP = os.getenv("DB_SHARD_MAP", f"{DB_PATH}.shards.json")
+# Точек на кольце у каждого шарда: чем больше, тем ровнее делятся пользователи
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "128"))
+SHARD_MAP_CHECK = float(os.getenv("SHARD_MAP_CHECK", "1"))
+
+
+def shard_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+
+class Ring:
+    def __init__(self, names, vnodes=SHARD_VNODES):
+        self.names = sorted(names)
+        points = sorted((_hash(f'{name}#{i}'), name) for name in self.names for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._owners = [name for _, name in points]
+
+    def owner(self, user_id):
+        i = bisect.bisect(self._points, _hash(int(user_id)))
+        return self._owners[i % len(self._owners)]
+
+
+# Раскладка: пути всех шардов, текущее кольцо и, во время решардинга, целевое кольцо
+class ShardMap:
+    def __init__(self, paths, ring, target=None, version=0):
+        self.paths = dict(paths)
+        self.ring = Ring(ring)
+        self.target = Ring(target) if target is not None else None
+        self.version = version
+
+    def to_json(self):
+        return {"version": self.version, "shards": self.paths, "ring": self.ring.names,
+                "target": self.target.names if self.target is not None else None}
+
+
+def from_paths(paths):
+    names = {shard_name(path): path for path in paths}
+    return ShardMap(names, list(names))
+
+
+def load():
+    try:
+        with open(DB_SHARD_MAP) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return from_paths(DB_SHARDS)
+    return ShardMap(data["shards"], data["ring"], data.get("target"), data.get("version", 0))
+
+
+def save(shard_map):
+    shard_map.version += 1
+    with open(DB_SHARD_MAP + '.tmp', 'w') as f:
+        json.dump(shard_map.to_json(), f, indent=2, ensure_ascii=False)
+    os.replace(DB_SHARD_MAP + '.tmp', DB_SHARD_MAP)
+
+
+_lock = threading.Lock()
+_map = None
+_map_mtime = None
+_next_check = 0.0
+
+
+def _refresh():
+    global _map, _map_mtime, _next_check
+    with _lock:
+        if time.monotonic() < _next_check:
+            return
+        try:
+            mtime = os.stat(DB_SHARD_MAP).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if _map is None or mtime != _map_mtime:
+            _map = load()
+            _map_mtime = mtime
+        _next_check = time.monotonic() + SHARD_MAP_CHECK
+
+
+def current():
+    if time.monotonic() >= _next_check:
+        _refresh()
+    return _map
+
+
+# Сразу перечитать файл раскладки (после его изменения в этом же процессе)
+def reload():
+    global _next_check
+    _next_check = 0.0
+    return current()
@@ -0,0 +1,157 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import struct
+import zlib
+
+from flask import Response, request
+
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+
+# Заранее собранный ответ (страница или пакет переводов): исходные байты, сжатые варианты и ETag
+class Shell:
+    def __init__(self, html):
+        self.body = html.encode('utf-8')
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.encodings = {'identity': self.body, 'gzip': gzip.compress(self.body, 9, mtime=0)}
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(self.body, quality=11, mode=brotli.MODE_TEXT)
+
+    # Строгий ETag для каждого варианта кодирования
+    def etag_for(self, encoding):
+        return self.etag if encoding == 'identity' else f'{self.etag}-{encoding}'
+
+
+# Заголовок gzip без имени файла и времени
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+_SLOT = re.compile(r'\{\{slot:(\w+)\}\}')
+
+
+def script_json(value):
+    # </ внутри строки не должен закрывать тег script
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).replace('</', '<\\/')
+
+
+def _deflate(data, final):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+# Несжатые блоки deflate: после Z_SYNC_FLUSH поток выровнен по байту, и такие блоки можно просто дописать
+def _stored(data):
+    blocks = []
+    for i in range(0, len(data), 0xffff):
+        chunk = data[i:i + 0xffff]
+        blocks.append(b'\x00' + struct.pack('<HH', len(chunk), len(chunk) ^ 0xffff) + chunk)
+    return b''.join(blocks)
+
+
+# Страница с местами {{slot:имя}} для значений конкретного пользователя.
+# Постоянные куски заранее сжаты в независимые блоки deflate; при отрисовке между ними вставляются
+# значения несжатыми блоками, так что gzip-ответ собирается без сжатия всей страницы.
+class Template:
+    def __init__(self, html):
+        parts = _SLOT.split(html)
+        self.fragments = [part.encode('utf-8') for part in parts[0::2]]
+        self.slots = parts[1::2]
+        last = len(self.fragments) - 1
+        self.deflated = [_deflate(fragment, i == last) for i, fragment in enumerate(self.fragments)]
+
+    # values - словарь {имя места: строка}
+    def render(self, values):
+        encoded = [values[slot].encode('utf-8') for slot in self.slots]
+        out = [self.fragments[0]]
+        for value, fragment in zip(encoded, self.fragments[1:]):
+            out.append(value)
+            out.append(fragment)
+        return b''.join(out)
+
+    def render_gzip(self, values):
+        encoded = [values[slot].encode('utf-8') for slot in self.slots]
+        crc = zlib.crc32(self.fragments[0])
+        size = len(self.fragments[0])
+        out = [GZIP_HEADER, self.deflated[0]]
+        for value, fragment, deflated in zip(encoded, self.fragments[1:], self.deflated[1:]):
+            if value:
+                out.append(_stored(value))
+            out.append(deflated)
+            crc = zlib.crc32(fragment, zlib.crc32(value, crc))
+            size += len(value) + len(fragment)
+        out.append(struct.pack('<II', crc, size & 0xffffffff))
+        return b''.join(out)
+
+    # Общая страница без данных пользователя
+    def shell(self, defaults):
+        return Shell(self.render(defaults).decode('utf-8'))
+
+
+def read_template(name):
+    with open(os.path.join(TEMPLATES_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+# transforms - функции, которые один раз переписывают разметку перед сборкой
+def prepare(name, *transforms):
+    html = read_template(name)
+    for transform in transforms:
+        html = transform(html)
+    return html
+
+
+def load(name, *transforms):
+    return Shell(prepare(name, *transforms))
+
+
+def load_template(name, *transforms):
+    return Template(prepare(name, *transforms))
+
+
+# Выбор кодирования по Accept-Encoding: br, затем gzip, иначе без сжатия
+def choose_encoding(shell):
+    accepted = request.accept_encodings
+    best, best_q = 'identity', 0
+    for encoding in ('br', 'gzip'):
+        if encoding not in shell.encodings:
+            continue
+        q = accepted[encoding]
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+# По умолчанию страница всегда перепроверяется, но при совпадении ETag тело не передается
+def respond(shell, content_type='text/html; charset=utf-8', cache_control='no-cache'):
+    encoding = choose_encoding(shell)
+    etag = shell.etag_for(encoding)
+    headers = {
+        'ETag': f'"{etag}"',
+        'Vary': 'Accept-Encoding',
+        'Cache-Control': cache_control,
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(shell.encodings[encoding], headers=headers, content_type=content_type)
+
+
+# Страница для конкретного пользователя: не кэшируется, сжимается только gzip из заранее сжатых кусков
+def respond_rendered(template, values):
+    headers = {'Vary': 'Accept-Encoding, Cookie', 'Cache-Control': 'private, no-store'}
+    with metrics.phase("template"):
+        if request.accept_encodings['gzip']:
+            headers['Content-Encoding'] = 'gzip'
+            body = template.render_gzip(values)
+        else:
+            body = template.render(values)
+    return Response(body, headers=headers, content_type='text/html; charset=utf-8')
@@ -0,0 +1,159 @@
+import mimetypes
+import os
+import stat
+import threading
+from collections import Counter
+
+from flask import Response, abort, request
+from werkzeug.http import http_date
+
+# Горячий набор: самые запрашиваемые файлы держим в памяти с готовыми заголовками
+STATIC_HOT_MAX_BYTES = int(os.getenv("STATIC_HOT_MAX_BYTES", str(64 * 1024 * 1024)))
+STATIC_HOT_MAX_FILE = int(os.getenv("STATIC_HOT_MAX_FILE", str(2 * 1024 * 1024)))
+STATIC_HOT_MIN_HITS = int(os.getenv("STATIC_HOT_MIN_HITS", "3"))
+STATIC_CHUNK = 64 * 1024
+
+
+# Файл с заранее посчитанными заголовками; body заполнен, только если файл в горячем наборе
+class Asset:
+    __slots__ = ('path', 'size', 'mtime', 'etag', 'headers', 'body')
+
+    def __init__(self, path, mimetype=None):
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            raise FileNotFoundError(path)
+        self.path = path
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.etag = f'{st.st_mtime_ns:x}-{st.st_size:x}'
+        self.headers = {
+            'Content-Type': mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream',
+            'ETag': f'"{self.etag}"',
+            'Last-Modified': http_date(self.mtime),
+            'Accept-Ranges': 'bytes',
+        }
+        self.body = None
+
+
+class HotSet:
+    def __init__(self, max_bytes=STATIC_HOT_MAX_BYTES, max_file=STATIC_HOT_MAX_FILE, min_hits=STATIC_HOT_MIN_HITS):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.min_hits = min_hits
+        self._assets = {}
+        self._hits = Counter()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, path, mimetype=None):
+        with self._lock:
+            asset = self._assets.get(path)
+        if asset is None:
+            try:
+                asset = Asset(path, mimetype)
+            except OSError:
+                return None
+        with self._lock:
+            asset = self._assets.setdefault(path, asset)
+            self._hits[path] += 1
+            hits = self._hits[path]
+        if asset.body is None and asset.size <= self.max_file and hits >= self.min_hits:
+            self._promote(asset)
+        return asset
+
+    # Загружает файл в память; при нехватке места вытесняет файлы, которые запрашивали реже
+    def _promote(self, asset):
+        with open(asset.path, 'rb') as f:
+            body = f.read()
+        with self._lock:
+            if asset.body is not None:
+                return
+            hits = self._hits[asset.path]
+            hot = sorted((a for a in self._assets.values() if a.body is not None), key=lambda a: self._hits[a.path])
+            while self._bytes + len(body) > self.max_bytes and hot and self._hits[hot[0].path] < hits:
+                victim = hot.pop(0)
+                self._bytes -= len(victim.body)
+                victim.body = None
+            if self._bytes + len(body) <= self.max_bytes:
+                asset.body = body
+                self._bytes += len(body)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": sum(1 for a in self._assets.values() if a.body is not None),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+hot_set = HotSet()
+
+
+def _file_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(STATIC_CHUNK, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+# Тело ответа из файла: через wsgi.file_wrapper (sendfile в gunicorn) или чтением по кускам
+def _file_body(path, start, length, size):
+    wrapper = request.environ.get('wsgi.file_wrapper')
+    # sendfile в gunicorn 20 всегда начинает с нулевого смещения, поэтому через него отдаем только целый файл
+    if wrapper is not None and start == 0 and length == size:
+        return wrapper(open(path, 'rb'), STATIC_CHUNK)
+    return _file_range(path, start, length)
+
+
+# If-Range с устаревшим ETag или датой означает, что нужно отдать файл целиком
+def _range_allowed(asset):
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == asset.etag
+    if if_range.date is not None:
+        return asset.mtime <= if_range.date.timestamp()
+    return True
+
+
+def _not_modified(asset):
+    if request.if_none_match:
+        return request.if_none_match.contains(asset.etag)
+    since = request.if_modified_since
+    return since is not None and asset.mtime <= since.timestamp()
+
+
+# Отдает файл с поддержкой условных запросов и Range
+def serve(path, mimetype=None, cache_control=None):
+    asset = hot_set.get(path, mimetype)
+    if asset is None:
+        abort(404)
+    headers = dict(asset.headers)
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    if _not_modified(asset):
+        return Response(status=304, headers=headers)
+
+    start, stop, status = 0, asset.size, 200
+    rng = request.range
+    # Несколько диапазонов сразу не поддерживаются: такой Range игнорируется и отдается весь файл (RFC 9110)
+    if rng is not None and rng.units == 'bytes' and len(rng.ranges) == 1 and _range_allowed(asset):
+        bounds = rng.range_for_length(asset.size)
+        if bounds is None:
+            headers['Content-Range'] = f'bytes */{asset.size}'
+            return Response(status=416, headers=headers)
+        start, stop = bounds
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{asset.size}'
+    length = stop - start
+    headers['Content-Length'] = str(length)
+
+    if asset.body is not None:
+        body = [asset.body[start:stop]] if status == 206 else [asset.body]
+    else:
+        body = _file_body(asset.path, start, length, asset.size)
+    return Response(body, status=status, headers=headers, direct_passthrough=True)
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import time
+
+import idempotency
+import ledger
+import profiles
+from db import HAS_RETURNING, read, write, write_async
+
+# Каталог предметов магазина и их цены в кристаллах
+PRICES = {'pajamas': 50, 'lingerie': 75, 'cat_ears': 30, 'vip_pass': 40, 'wine_bottle': 12, 'control_charm': 20, 'flower_bouquet': 15}
+# Пакеты кристаллов, которые продаются в разделе "Валюта"
+DIAMOND_PACKS = [85, 210, 540, 1360, 2720, 5000]
+
+CATALOG = {"items": PRICES, "diamond_packs": DIAMOND_PACKS}
+CATALOG_VERSION = hashlib.sha256(json.dumps(CATALOG, sort_keys=True).encode()).hexdigest()[:12]
+
+if HAS_RETURNING:
+    DEBIT_SQL = "UPDATE users SET diamonds = diamonds - ? WHERE user_id = ? AND diamonds >= ? RETURNING diamonds"
+    CREDIT_SQL = ("INSERT INTO users (user_id, diamonds) VALUES (?, ?) "
+                  "ON CONFLICT(user_id) DO UPDATE SET diamonds = diamonds + excluded.diamonds RETURNING diamonds")
+else:
+    DEBIT_SQL = "UPDATE users SET diamonds = diamonds - ? WHERE user_id = ? AND diamonds >= ?"
+    CREDIT_SQL = ("INSERT INTO users (user_id, diamonds) VALUES (?, ?) "
+                  "ON CONFLICT(user_id) DO UPDATE SET diamonds = diamonds + excluded.diamonds")
+
+
+INVENTORY_SQL = ("INSERT INTO inventory (user_id, item, count) VALUES (?, ?, 1) "
+                 "ON CONFLICT(user_id, item) DO UPDATE SET count = count + 1")
+
+
+def _returning(conn, cursor, user_id):
+    if HAS_RETURNING:
+        # fetchall дочитывает выражение до конца, чтобы оно не мешало COMMIT
+        rows = cursor.fetchall()
+        return rows[0][0] if rows else None
+    if cursor.rowcount == 0:
+        return None
+    return conn.execute("SELECT diamonds FROM users WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+
+def _debit(conn, user_id, item, price):
+    # Проверка баланса и списание одним условным UPDATE: двойная трата невозможна
+    diamonds = _returning(conn, conn.execute(DEBIT_SQL, (price, user_id, price)), user_id)
+    if diamonds is None:
+        # Новый пользователь: создаем запись и пробуем еще раз (бесплатные предметы)
+        if conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,)).rowcount == 0:
+            return None
+        diamonds = _returning(conn, conn.execute(DEBIT_SQL, (price, user_id, price)), user_id)
+        if diamonds is None:
+            return None
+    purchase_id = conn.execute("INSERT INTO purchases (user_id, item, price, created_at) VALUES (?, ?, ?, ?)",
+                               (user_id, item, price, int(time.time()))).lastrowid
+    conn.execute(INVENTORY_SQL, (user_id, item))
+    if price:
+        ledger.append(conn, user_id, -price, 'buy_item', purchase_id)
+    return diamonds
+
+
+# Проверка владения и список предметов идут по первичному ключу inventory
+def owns(user_id, item):
+    return read(lambda conn: conn.execute("SELECT 1 FROM inventory WHERE user_id = ? AND item = ?", (user_id, item)).fetchone(),
+                user_id) is not None
+
+
+def inventory(user_id):
+    return dict(read(lambda conn: conn.execute("SELECT item, count FROM inventory WHERE user_id = ?", (user_id,)).fetchall(), user_id))
+
+
+def _debit_job(user_id, item):
+    price = PRICES.get(item, 0)
+    return lambda conn: _debit(conn, user_id, item, price)
+
+
+def _credit(conn, user_id, amount):
+    diamonds = _returning(conn, conn.execute(CREDIT_SQL, (user_id, amount)), user_id)
+    ledger.append(conn, user_id, amount, 'buy_diamonds')
+    return diamonds
+
+
+def _credit_job(user_id, amount):
+    return lambda conn: _credit(conn, user_id, amount)
+
+
+def _remember(user_id, outcome):
+    diamonds, replayed = outcome
+    # Повтор возвращает результат исходного запроса; баланс в кэше мог с тех пор измениться
+    if diamonds is not None and not replayed:
+        profiles.set_diamonds(user_id, diamonds)
+    return diamonds
+
+
+def _buy_job(user_id, item, idempotency_key):
+    key = idempotency.make_key(user_id, 'buy_item', idempotency_key)
+    return idempotency.wrap(_debit_job(user_id, item), key, item, user_id)
+
+
+def _add_job(user_id, amount, idempotency_key):
+    key = idempotency.make_key(user_id, 'buy_diamonds', idempotency_key)
+    return idempotency.wrap(_credit_job(user_id, amount), key, str(amount), user_id)
+
+
+# Покупка предмета; возвращает новый баланс или None, если кристаллов не хватает.
+# Повтор с тем же idempotency_key возвращает результат первой покупки, не списывая кристаллы снова.
+def buy_item(user_id, item, idempotency_key=None):
+    return _remember(user_id, write(_buy_job(user_id, item, idempotency_key), user_id))
+
+
+# Зачисление кристаллов; возвращает новый баланс
+def add_diamonds(user_id, amount, idempotency_key=None):
+    return _remember(user_id, write(_add_job(user_id, amount, idempotency_key), user_id))
+
+
+async def buy_item_async(user_id, item, idempotency_key=None):
+    return _remember(user_id, await write_async(_buy_job(user_id, item, idempotency_key), user_id))
+
+
+async def add_diamonds_async(user_id, amount, idempotency_key=None):
+    return _remember(user_id, await write_async(_add_job(user_id, amount, idempotency_key), user_id))